@@ -0,0 +1,281 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+
+# -----------------------------------------------------------
+# A fake Pocket
+# -----------------------------------------------------------
+# An in-memory stand-in for /v3/get and /v3/send, good enough to run
+# every pocketsnack command against without touching the real API.
+# Accounts are generated from a seed, so the same size always gives
+# the same account. About 5% of items share a URL with an earlier
+# item (for --dedupe), most of the archive is tagged 'tbr', and a few
+# items are videos, images or favorites.
+#
+# Responses carry X-Limit-User-* headers like the real thing. Once
+# 'user_limit' calls have been made we answer 403 until the window
+# resets, 'reset' seconds after it started (an hour, like Pocket).
+# 'latency' is added to every call.
+
+class Account:
+
+  def __init__(self, size, seed=1):
+    rnd = random.Random(seed)
+    self.lock = threading.Lock()
+    self.items = {}
+    self.deleted = {} # item_id -> time it was deleted, sent as tombstones
+    self.clock = 1600000000
+    # counters for the benchmark report
+    self.requests = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    # rate limits
+    self.user_limit = 10000000
+    self.reset = 3600
+    self.window_started = time.monotonic()
+    self.window_requests = 0
+
+    for i in range(size):
+      item_id = str(1000 + i)
+      self.clock += 10
+      url = 'https://example.com/article/%d' % (i if rnd.random() > 0.05 else rnd.randrange(max(i, 1)))
+      status = '0' if rnd.random() < 0.3 else '1'
+      tags = {}
+      if status == '1' and rnd.random() < 0.7:
+        tags['tbr'] = {'item_id': item_id, 'tag': 'tbr'}
+      if rnd.random() < 0.3:
+        tags['misc'] = {'item_id': item_id, 'tag': 'misc'}
+      self.items[item_id] = {
+        'item_id': item_id,
+        'resolved_id': item_id,
+        'given_url': url,
+        'resolved_url': url,
+        'given_title': 'Title %d' % i,
+        'resolved_title': 'Title %d' % i,
+        'favorite': '1' if rnd.random() < 0.05 else '0',
+        'status': status,
+        'time_added': str(self.clock),
+        'time_updated': str(self.clock),
+        'time_read': '0',
+        'time_favorited': '0',
+        'excerpt': 'lorem ipsum ' * 20,
+        'is_article': '1',
+        'has_video': '2' if rnd.random() < 0.03 else '0',
+        'has_image': '2' if rnd.random() < 0.03 else '1',
+        'word_count': str(rnd.randrange(50, 8000)),
+        'tags': tags,
+        'authors': {'1': {'author_id': '1', 'name': 'Someone'}},
+        'images': {'1': {'src': 'https://example.com/img.png'}},
+      }
+      if not tags:
+        del self.items[item_id]['tags']
+
+  # count a call against the current window, starting a new one if it
+  # has run out. Returns the calls left and seconds until the reset
+  # call with the lock held
+  def count_call(self):
+    now = time.monotonic()
+    if now - self.window_started >= self.reset:
+      self.window_started = now
+      self.window_requests = 0
+    self.requests += 1
+    self.window_requests += 1
+    return self.user_limit - self.window_requests, math.ceil(self.window_started + self.reset - now)
+
+  def touch(self, item):
+    self.clock += 1
+    item['time_updated'] = str(self.clock)
+
+  def matches(self, item, query, since):
+    state = query.get('state', 'unread')
+    if state == 'unread' and item['status'] != '0':
+      return False
+    if state == 'archive' and item['status'] != '1':
+      return False
+    if 'favorite' in query and item['favorite'] != str(query['favorite']):
+      return False
+    tag = query.get('tag')
+    if tag == '_untagged_' and item.get('tags'):
+      return False
+    if tag and tag != '_untagged_' and tag not in item.get('tags', {}):
+      return False
+    if since is not None and int(item['time_updated']) < since:
+      return False
+    return True
+
+  def get(self, query):
+    since = float(query['since']) if query.get('since') else None
+    with self.lock:
+      found = [item for item in self.items.values() if self.matches(item, query, since)]
+      if since is not None:
+        found.extend({'item_id': item_id, 'status': '2'} for item_id, deleted in self.deleted.items() if deleted >= since)
+      now = self.clock + 1
+    found.sort(key=lambda item: int(item.get('time_added', 0)), reverse=query.get('sort') != 'oldest')
+    if 'count' in query:
+      offset = int(query.get('offset', 0))
+      found = found[offset:offset + int(query['count'])]
+    if query.get('detailType', 'simple') == 'simple':
+      found = [{key: value for key, value in item.items() if key not in ('tags', 'authors', 'images')} for item in found]
+    # like Pocket, an empty list is [] rather than {}
+    return {'status': 1, 'complete': 1, 'list': {item['item_id']: item for item in found} if found else [], 'since': now}
+
+  def send(self, actions):
+    results = []
+    with self.lock:
+      for action in actions:
+        item = self.items.get(str(action['item_id']))
+        if item is None:
+          results.append(False)
+          continue
+        kind = action['action']
+        tags = action.get('tags', [])
+        if isinstance(tags, str):
+          tags = [tag.strip() for tag in tags.split(',')]
+        if kind == 'archive':
+          item['status'] = '1'
+        elif kind == 'readd':
+          item['status'] = '0'
+        elif kind == 'favorite':
+          item['favorite'] = '1'
+        elif kind == 'delete':
+          del self.items[item['item_id']]
+          self.clock += 1
+          self.deleted[item['item_id']] = self.clock
+          results.append(True)
+          continue
+        elif kind == 'tags_add':
+          item.setdefault('tags', {}).update({tag: {'item_id': item['item_id'], 'tag': tag} for tag in tags})
+        elif kind == 'tags_remove':
+          for tag in tags:
+            item.get('tags', {}).pop(tag, None)
+        elif kind == 'tags_replace':
+          item['tags'] = {tag: {'item_id': item['item_id'], 'tag': tag} for tag in tags}
+        elif kind == 'tags_clear':
+          item.pop('tags', None)
+        self.touch(item)
+        results.append(True)
+    return {'status': 1, 'action_results': results}
+
+def make_handler(account, latency=0.0):
+
+  class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def limit_headers(self, remaining, reset):
+      self.send_header('X-Limit-User-Limit', str(account.user_limit))
+      self.send_header('X-Limit-User-Remaining', str(max(remaining, 0)))
+      self.send_header('X-Limit-User-Reset', str(reset))
+
+    def do_POST(self):
+      time.sleep(latency)
+      length = int(self.headers.get('Content-Length') or 0)
+      body = self.rfile.read(length) if length else b''
+      with account.lock:
+        account.bytes_in += len(self.path) + length
+        remaining, reset = account.count_call()
+      if remaining < 0:
+        self.send_response(403)
+        self.send_header('Content-Length', '0')
+        self.limit_headers(remaining, reset)
+        self.end_headers()
+        return
+
+      parsed = urllib.parse.urlparse(self.path)
+      query = dict(urllib.parse.parse_qsl(parsed.query))
+      if body:
+        try:
+          query.update(json.loads(body))
+        except ValueError:
+          pass
+      if parsed.path.endswith('/get'):
+        payload = account.get(query)
+      elif parsed.path.endswith('/send'):
+        actions = query.get('actions', [])
+        if isinstance(actions, str):
+          actions = json.loads(actions)
+        payload = account.send(actions)
+      else:
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+
+      data = json.dumps(payload).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+        data = gzip.compress(data, compresslevel=1)
+        self.send_header('Content-Encoding', 'gzip')
+      self.send_header('Content-Length', str(len(data)))
+      self.limit_headers(remaining, reset)
+      self.end_headers()
+      with account.lock:
+        account.bytes_out += len(data)
+      self.wfile.write(data)
+
+  return Handler
+
+# start a fake Pocket in a background thread
+# returns the server (server.server_port is the port) and the Account
+def serve(size=1000, latency=0.0, port=0, user_limit=None, reset=None, seed=1):
+  account = Account(size, seed)
+  if user_limit:
+    account.user_limit = user_limit
+  if reset is not None:
+    account.reset = reset
+  server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(account, latency))
+  server.daemon_threads = True
+  # a client hanging up early isn't worth a traceback
+  server.handle_error = lambda request, address: None
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, account
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='run a fake Pocket API for testing pocketsnack')
+  parser.add_argument('--size', type=int, default=1000, help='how many items in the account')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+  parser.add_argument('--user-limit', type=int, help='calls allowed before answering 403')
+  parser.add_argument('--reset', type=float, help='seconds before the --user-limit window starts again (default 3600)')
+  args = parser.parse_args()
+  server, account = serve(args.size, args.latency, args.port, args.user_limit, args.reset)
+  print('fake Pocket on http://127.0.0.1:' + str(server.server_port) + '/v3 with ' + str(args.size) + ' items')
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
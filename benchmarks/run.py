@@ -0,0 +1,249 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from argparse import SUPPRESS, ArgumentParser
+import builtins
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# -----------------------------------------------------------
+# Benchmarks
+# -----------------------------------------------------------
+# Runs the main pocketsnack commands end to end against a fake Pocket
+# (fakepocket.py) with accounts of different sizes, and reports how
+# long each took, how many calls it made, and how many bytes went each
+# way. Each account size runs in its own process so peak memory is
+# measured separately.
+#
+#   python benchmarks/run.py                       # 1k, 10k and 100k items
+#   python benchmarks/run.py --sizes 1000 --json new.json
+#   python benchmarks/run.py --compare old.json    # flag regressions
+#   python benchmarks/run.py --async               # through pocketsnack.aio
+#
+# The commands run in this order, each on the account the one before
+# it left behind: info, stash, purge, dedupe, lucky dip. If any of them
+# says changes could not be sent, the benchmark fails.
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+commands = ['info', 'stash', 'purge', 'dedupe', 'lucky_dip']
+
+# the same commands through the asyncio API (see aio.py)
+# each one gets its own session on one event loop
+def async_steps():
+  import asyncio
+  from pocketsnack import aio
+  loop = asyncio.new_event_loop()
+
+  def step(command, *args, **kwargs):
+
+    async def run():
+      async with aio.session() as http:
+        return await command(http, *args, **kwargs)
+
+    return lambda: loop.run_until_complete(run())
+
+  return {
+    'info': step(aio.info_stats, 'key', 'token', False, 3000, False, False),
+    'stash': step(aio.stash, 'key', 'token', 'tbr', False, {'keep'}, True, {'misc'}, False, False),
+    'purge': step(aio.purge_tags, 'archive', {'keep'}, 'tbr', 'key', 'token', False, False),
+    'dedupe': step(aio.dedupe, 'all', False, True, 'key', 'token', delete=True),
+    'lucky_dip': step(aio.lucky_dip, 'key', 'token', 'tbr', 10, 1, 1, 2, 3000, False, False),
+  }
+
+# run every command against a fresh fake account of 'size' items
+# returns a dict of results for the report
+def run_size(size, latency, user_limit, reset, deadline, send_rate, local_store, use_async=False):
+  import fakepocket
+  from pocketsnack import retry
+  from pocketsnack import toolkit as pt
+
+  server, account = fakepocket.serve(size, latency, user_limit=user_limit, reset=reset)
+  workdir = tempfile.mkdtemp(prefix='pocketsnack-bench-')
+  pt.configure({
+    'api_url': 'http://127.0.0.1:' + str(server.server_port) + '/v3',
+    'local_store': os.path.join(workdir, 'store.db') if local_store else None,
+    'journal': os.path.join(workdir, 'journal.db'),
+    'send_rate': send_rate,
+    'send_burst': max(1, int(send_rate)),
+    'retry_base_delay': 0.1,
+    # a throttled command fails rather than waiting out the limit
+    'command_deadline': deadline,
+    })
+  # nobody is there to confirm the dedupe
+  builtins.input = lambda prompt='': 'delete'
+
+  steps = {
+    'info': lambda: pt.info_stats('key', 'token', False, 3000, False, False),
+    'stash': lambda: pt.stash('key', 'token', 'tbr', False, {'keep'}, True, {'misc'}, False, False),
+    'purge': lambda: pt.purge_tags('archive', {'keep'}, 'tbr', 'key', 'token', False, False),
+    'dedupe': lambda: pt.dedupe('all', False, True, 'key', 'token'),
+    'lucky_dip': lambda: pt.lucky_dip('key', 'token', 'tbr', 10, 1, 1, 2, 3000, False, False),
+  }
+  if use_async:
+    steps = async_steps()
+
+  results = {}
+  for name in commands:
+    before = (account.requests, account.bytes_in, account.bytes_out)
+    started = time.perf_counter()
+    # keep the commands' progress messages out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+      try:
+        message = steps[name]()
+      except retry.PocketError as error:
+        sys.exit(name + ' failed: ' + str(error))
+    results[name] = {
+      'seconds': round(time.perf_counter() - started, 3),
+      'requests': account.requests - before[0],
+      'bytes_sent': account.bytes_in - before[1],
+      'bytes_received': account.bytes_out - before[2],
+    }
+    if isinstance(message, str) and ('could not' in message or 'refused' in message or 'Sorry' in message):
+      sys.exit(name + ' failed: ' + message)
+  server.shutdown()
+  shutil.rmtree(workdir, ignore_errors=True)
+  # ru_maxrss is in kilobytes on Linux and bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return {'commands': results, 'peak_rss_mb': round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)}
+
+# ----------------
+# Reporting
+# ----------------
+
+def kb(value):
+  return str(round(value / 1024)) + ' KB'
+
+def text_report(report):
+  lines = ['pocketsnack benchmarks - ' + report['python'] + ', latency ' + str(report['latency']) + 's' + (', asyncio' if report.get('async') else ''), '']
+  header = '{:>8}  {:<10} {:>9} {:>9} {:>12} {:>12}'
+  lines.append(header.format('items', 'command', 'seconds', 'requests', 'sent', 'received'))
+  for size, result in report['sizes'].items():
+    for name, row in result['commands'].items():
+      lines.append(header.format(size, name, '%.3f' % row['seconds'], row['requests'], kb(row['bytes_sent']), kb(row['bytes_received'])))
+    lines.append('{:>8}  {:<10} {:>9}'.format(size, 'peak RSS', str(result['peak_rss_mb']) + ' MB'))
+    lines.append('')
+  return '\n'.join(lines)
+
+# compare with an earlier report, returning lines describing anything
+# that got worse by more than 'threshold' (0.2 is 20%)
+def regressions(report, baseline, threshold):
+  found = []
+  for size, result in report['sizes'].items():
+    old = baseline['sizes'].get(size)
+    if not old:
+      continue
+    for name, row in result['commands'].items():
+      old_row = old['commands'].get(name)
+      if not old_row:
+        continue
+      for metric in ('seconds', 'requests', 'bytes_sent', 'bytes_received'):
+        before, after = old_row[metric], row[metric]
+        # ignore tiny timings, they're mostly noise
+        if metric == 'seconds' and max(before, after) < 0.05:
+          continue
+        if after > before * (1 + threshold) and after - before > 0:
+          change = '+' + str(round((after - before) * 100 / before)) + '%' if before else 'new'
+          found.append(size + ' ' + name + ' ' + metric + ': ' + str(before) + ' -> ' + str(after) + ' (' + change + ')')
+    if result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + threshold):
+      found.append(size + ' peak RSS: ' + str(old['peak_rss_mb']) + ' MB -> ' + str(result['peak_rss_mb']) + ' MB')
+  return found
+
+def main():
+  parser = ArgumentParser(description='benchmark pocketsnack commands against a fake Pocket API')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='account sizes to test')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+  parser.add_argument('--user-limit', type=int, help='API calls allowed before the fake Pocket answers 403')
+  parser.add_argument('--reset', type=float, help='seconds before the --user-limit window starts again (default 3600)')
+  parser.add_argument('--deadline', type=float, default=300, help='seconds allowed for each command before it fails (default 300)')
+  parser.add_argument('--send-rate', type=float, default=50, help='send_rate for the toolkit (requests per second)')
+  parser.add_argument('--store', action='store_true', help='use a local store, as the default config does')
+  parser.add_argument('--async', dest='use_async', action='store_true', help='run the commands through pocketsnack.aio (needs aiohttp)')
+  parser.add_argument('--json', metavar='FILE', help='also write the report to FILE as JSON')
+  parser.add_argument('--compare', metavar='FILE', help='compare with an earlier JSON report and exit 1 on regressions')
+  parser.add_argument('--threshold', type=float, default=0.2, help='how much worse counts as a regression (default 0.2 = 20%%)')
+  # used by the benchmark to run each size in its own process
+  parser.add_argument('--child', type=int, help=SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    result = run_size(args.child, args.latency, args.user_limit, args.reset, args.deadline, args.send_rate, args.store, args.use_async)
+    print(json.dumps(result))
+    return
+
+  report = {
+    'python': platform.python_implementation() + ' ' + platform.python_version(),
+    'latency': args.latency,
+    'store': args.store,
+    'async': args.use_async,
+    'sizes': {},
+  }
+  for size in args.sizes:
+    command = [sys.executable, os.path.abspath(__file__), '--child', str(size), '--latency', str(args.latency), '--send-rate', str(args.send_rate), '--deadline', str(args.deadline)]
+    if args.user_limit:
+      command += ['--user-limit', str(args.user_limit)]
+    if args.reset is not None:
+      command += ['--reset', str(args.reset)]
+    if args.store:
+      command.append('--store')
+    if args.use_async:
+      command.append('--async')
+    child = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    # the child has already said what went wrong
+    if child.returncode:
+      sys.exit(child.returncode)
+    report['sizes'][str(size)] = json.loads(child.stdout.strip().splitlines()[-1])
+
+  print(text_report(report))
+  if args.json:
+    with open(args.json, 'w') as report_file:
+      json.dump(report, report_file, indent=2)
+
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)
+    for setting in ('python', 'latency', 'store', 'async'):
+      if baseline.get(setting) != report[setting]:
+        print('Note: ' + args.compare + ' was run with ' + setting + ' ' + str(baseline.get(setting)) + ', not ' + str(report[setting]) + '.')
+    found = regressions(report, baseline, args.threshold)
+    if found:
+      print('Regressions against ' + args.compare + ':')
+      for line in found:
+        print('  ' + line)
+      sys.exit(1)
+    print('No regressions against ' + args.compare + '.')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,97 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from argparse import ArgumentParser
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# -----------------------------------------------------------
+# Startup benchmark
+# -----------------------------------------------------------
+# Times how long 'pocketsnack --version' and 'pocketsnack --help' take
+# from start to finish, which is mostly the time spent importing things.
+# Cron jobs and shell completion pay this on every call.
+#
+#   python benchmarks/startup.py                 # median of 20 runs each
+#   python benchmarks/startup.py --target 150    # exit 1 if slower than 150ms
+#
+# It also lists any of the slow imports (requests, rich, yaml,
+# pkg_resources) that were loaded, since none of them are needed here.
+# Python's own startup time is shown for comparison.
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+commands = {
+  'python': ['-c', 'pass'],
+  '--version': ['-m', 'pocketsnack.pocketsnack', '--version'],
+  '--help': ['-m', 'pocketsnack.pocketsnack', '--help'],
+}
+heavy = ['requests', 'rich', 'yaml', 'pkg_resources', 'pocketsnack.toolkit']
+
+def environment():
+  env = dict(os.environ)
+  env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+  return env
+
+# milliseconds for each of 'runs' runs
+def time_command(args, runs):
+  timings = []
+  for i in range(runs):
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + args, check=True, stdout=subprocess.DEVNULL, env=environment())
+    timings.append((time.perf_counter() - started) * 1000)
+  return timings
+
+# which of the heavy modules the command imports
+def heavy_imports(args):
+  output = subprocess.run([sys.executable, '-X', 'importtime'] + args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, env=environment()).stderr
+  loaded = set(line.rsplit('|', 1)[-1].strip() for line in output.splitlines() if '|' in line)
+  return [name for name in heavy if name in loaded]
+
+def main():
+  parser = ArgumentParser(description='time how long pocketsnack takes to start')
+  parser.add_argument('--runs', type=int, default=20, help='how many times to run each command')
+  parser.add_argument('--target', type=float, help='exit 1 if the median for --version or --help is more than this many milliseconds')
+  args = parser.parse_args()
+
+  print('{:<10} {:>10} {:>10}  {}'.format('command', 'median ms', 'min ms', 'slow imports'))
+  slow = []
+  for name, command in commands.items():
+    timings = time_command(command, args.runs)
+    median = statistics.median(timings)
+    loaded = heavy_imports(command) if name != 'python' else []
+    print('{:<10} {:>10.1f} {:>10.1f}  {}'.format(name, median, min(timings), ', '.join(loaded) or '-'))
+    if args.target and name != 'python' and median > args.target:
+      slow.append(name)
+
+  if slow:
+    print('Slower than ' + str(args.target) + 'ms: ' + ', '.join(slow))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,144 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import copy
+import io
+import json
+import sys
+import time
+import traceback
+
+# -----------------------------------------------------------
+# Several accounts
+# -----------------------------------------------------------
+# Each document in the config file (separated by '---') is a Pocket
+# account with its own settings. Commands that don't ask any questions
+# run for every account at once, each in its own process, so the toolkit's
+# settings, connections and rate limits for one account never get
+# mixed up with another's. 'parallel' caps how many run at a time.
+#
+# Each account's output is collected and printed in one piece when it
+# finishes, followed by a summary, so a nightly run over a dozen
+# accounts takes about as long as the slowest one. With --output json
+# or ndjson the account headings and summary go to stderr, leaving only
+# the accounts' own output on stdout: one JSON object keyed by account
+# name, or NDJSON rows that each carry an 'account'.
+#
+# Accounts that would write the same metrics_file each write their
+# own instead, named after the account (see metrics.account_path).
+
+# commands that can run for several accounts at once
+parallel_commands = ['stash', 'purge', 'lucky_dip', 'info', 'resume', 'test']
+default_parallel = 4
+
+# what to call each account: its 'account_name' setting, or its place in the file
+def account_names(documents):
+  return [S.get('account_name') or 'account ' + str(number) for number, S in enumerate(documents, 1)]
+
+# does this command run once per account?
+def runs_per_account(options):
+  return any(getattr(options, command) for command in parallel_commands)
+
+# the metrics file each account writes, or None
+# accounts sharing a file get one each
+def metrics_files(options, documents, names):
+  paths = [options.metrics_file or S.get('metrics_file') for S in documents]
+  from pocketsnack import metrics
+  return [metrics.account_path(path, name) if path and paths.count(path) > 1 else path for path, name in zip(paths, names)]
+
+# run the command for one account in a worker process
+# returns a dict with everything it printed to stdout and stderr, how long it took, and any error
+def run_account(options, S, name=None, metrics_file=None):
+  from pocketsnack import metrics
+  from pocketsnack import pocketsnack as cli
+
+  # a forked worker starts with whatever the last account left behind
+  metrics.reset()
+  options = copy.copy(options)
+  options.metrics_file = metrics_file
+  S = dict(S, account_name=name or S.get('account_name'), metrics_file=metrics_file)
+  output = io.StringIO()
+  errors = io.StringIO()
+  started = time.time()
+  error = None
+  with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+    try:
+      cli.run(options, S)
+    except Exception as e:
+      error = type(e).__name__ + ': ' + str(e)
+      traceback.print_exc()
+  return {'output': output.getvalue(), 'errors': errors.getvalue(), 'seconds': round(time.time() - started, 3), 'error': error}
+
+# an account's --output json, or None if it printed something else
+# (an error message, say), which goes to stderr with its other errors
+def json_output(result):
+  try:
+    return json.loads(result['output'])
+  except ValueError:
+    print(result['output'], end='', file=sys.stderr, flush=True)
+    return None
+
+def summary_message(names, results, wall_seconds):
+  lines = ['  [highlight] ' + str(len(names)) + ' accounts [/highlight] in ' + str(round(wall_seconds, 1)) + ' seconds:']
+  for name, result in zip(names, results):
+    status = 'failed: ' + result['error'] if result['error'] else 'ok'
+    lines.append('    {:<24} {:>8.1f}s  {}'.format(name, result['seconds'], status))
+  return '\n'.join(lines)
+
+# run the command for every account, at most 'parallel' at a time
+# prints each account's output as it finishes, then the summary
+def run_all(options, documents, console, parallel=None):
+  if options.output in ('json', 'ndjson'):
+    from rich.console import Console
+    from pocketsnack.toolkit import custom_theme
+    console = Console(theme=custom_theme, highlight=False, stderr=True)
+  names = account_names(documents)
+  paths = metrics_files(options, documents, names)
+  results = [None] * len(documents)
+  # several JSON documents in a row isn't JSON, so they're printed together at the end
+  collected = {} if options.output == 'json' else None
+  started = time.time()
+  with ProcessPoolExecutor(max_workers=max(1, min(int(parallel or default_parallel), len(documents)))) as pool:
+    futures = {pool.submit(run_account, options, S, names[number], paths[number]): number for number, S in enumerate(documents)}
+    for future in as_completed(futures):
+      number = futures[future]
+      try:
+        result = future.result()
+      except Exception as e:
+        # the worker process itself died
+        result = {'output': '', 'errors': '', 'seconds': round(time.time() - started, 3), 'error': type(e).__name__ + ': ' + str(e)}
+      results[number] = result
+      console.rule(names[number])
+      if collected is None:
+        print(result['output'], end='', flush=True)
+      else:
+        collected[names[number]] = json_output(result)
+      print(result['errors'], end='', file=sys.stderr, flush=True)
+  console.rule()
+  console.print(summary_message(names, results, time.time() - started))
+  if collected is not None:
+    print(json.dumps({name: collected[name] for name in names}, indent=2))
+  return results
@@ -0,0 +1,357 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# aiohttp is optional: pip install pocketsnack[async]
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+# bundled with Python
+import asyncio
+import json
+import queue
+
+# local modules
+from pocketsnack import retry
+from pocketsnack.items import Item
+from pocketsnack import toolkit as pt
+
+# -----------------------------------------------------------
+# asyncio API
+# -----------------------------------------------------------
+# The same operations as pocketsnack.toolkit, for use inside an
+# asyncio event loop. Every function takes an aiohttp ClientSession
+# as its first argument:
+#
+#   async with aio.session() as http:
+#     message = await aio.stash(http, consumer_key, access_token, ...)
+#
+# Settings (api_url, page_size, batch limits, send_workers, the
+# token bucket and dry_run) are shared with the toolkit, so
+# pt.configure() applies here too. The local store and the journal are
+# not used - SQLite calls would block the event loop - so there is
+# nothing for --resume to pick up if a command is interrupted.
+#
+# Items are handed to the toolkit's planners (stash_actions,
+# choose_lucky_dip etc) a page at a time as they arrive, on a worker
+# thread (see plan_with), so the whole account is never held at once.
+
+def session():
+  if aiohttp is None:
+    raise ImportError('the asyncio API needs aiohttp - install it with: pip install pocketsnack[async]')
+  connector = aiohttp.TCPConnector(limit=pt.pool_size)
+  timeout = aiohttp.ClientTimeout(sock_connect=pt.timeout[0], sock_read=pt.timeout[1])
+  return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+# aiohttp only accepts strings in query params
+def query_params(params):
+  return {key: str(value) for key, value in params.items()}
+
+# POST to the API, paced by the toolkit's rate limit scheduler and
+# retried with the toolkit's retry policy
+# returns the decoded JSON response, or raises retry.PocketUnavailable
+# (or retry.PocketError if Pocket turns the request down)
+async def call(http, endpoint, **kwargs):
+  attempt = 0
+  while True:
+    wait = pt.scheduler.reserve_slot(retry.time_left())
+    if wait is None:
+      raise retry.out_of_time()
+    if wait > 0:
+      await asyncio.sleep(wait)
+    try:
+      async with http.post(pt.api_url + endpoint, headers=pt.headers, **kwargs) as response:
+        pt.scheduler.update(response.status, response.headers)
+        kind = retry.classify(response.status, pt.scheduler.throttled(response.status, response.headers))
+        if kind is None:
+          # not raise_for_status(), which would put the access token in the error
+          if response.status >= 400:
+            raise retry.refused(response.status, response.headers.get('X-Error') or response.reason)
+          return await response.json(content_type=None)
+        delay = pt.retry_policy.delay(attempt, kind, response.headers.get('Retry-After'))
+        if not retry.should_retry(pt.retry_policy, attempt, delay):
+          raise retry.give_up(pt.retry_policy, attempt, response.status)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+      delay = pt.retry_policy.delay(attempt, 'connect')
+      if not retry.should_retry(pt.retry_policy, attempt, delay):
+        raise retry.give_up(pt.retry_policy, attempt)
+    attempt += 1
+    await asyncio.sleep(delay)
+
+# send GET requests
+async def get(http, params):
+  page = await call(http, '/get', params=query_params(params))
+  # Pocket sends [] rather than {} when there's nothing to send
+  page['list'] = page['list'] or {}
+  return page
+
+# send POST requests
+async def send(http, actions, consumer_key, pocket_access_token):
+  body = {"consumer_key": consumer_key, "access_token": pocket_access_token, "actions": actions}
+  return await call(http, '/send', data=json.dumps(body))
+
+# wait for a token from a dispatch.TokenBucket without blocking the loop
+async def take(bucket):
+  wait = bucket.try_take()
+  while wait:
+    await asyncio.sleep(wait)
+    wait = bucket.try_take()
+
+# ----------------
+# Retrieving items
+# ----------------
+
+# yield a list of (item_id, Item) pairs for each page, keeping several pages in flight at once
+# pages still come out in order, and we stop at the first short page
+# each Item keeps only 'fields', as in the toolkit
+async def iter_pages(http, params, fields=None, concurrency=None):
+  params = dict(params)
+  params.setdefault('sort', 'newest')
+  params['count'] = pt.page_size
+  window = max(1, concurrency or pt.send_workers)
+
+  def fetch(offset):
+    return asyncio.ensure_future(get(http, dict(params, offset=offset)))
+
+  pending = [fetch(n * pt.page_size) for n in range(window)]
+  next_offset = window * pt.page_size
+  try:
+    while pending:
+      page = await pending.pop(0)
+      yield [(item_id, Item.from_json(item_id, data, fields)) for item_id, data in page['list'].items()]
+      if len(page['list']) < pt.page_size:
+        break
+      pending.append(fetch(next_offset))
+      next_offset += pt.page_size
+  finally:
+    for task in pending:
+      task.cancel()
+
+# yield (item_id, Item) pairs as they arrive
+async def iter_items(http, params, fields=None, concurrency=None):
+  async for page in iter_pages(http, params, fields, concurrency):
+    for pair in page:
+      yield pair
+
+# pages of the items matching params, honouring the before/since/between filters
+# 'fields' picks the detailType, as in pt.iter_item_list
+async def iter_item_pages(http, params, before, since, between=None, fields=None):
+  earliest, latest = pt.time_window(before, since, between)
+  if earliest:
+    params['since'] = earliest
+  if fields is not None:
+    fields = set(fields) | {'time_updated'}
+    if earliest:
+      fields.add('status')
+    params['detailType'] = pt.detail_type(fields)
+  async for page in iter_pages(http, params, fields):
+    yield list(pt.updated_before(page, latest))
+
+# stream the items matching params, honouring the before/since/between filters
+async def iter_item_list(http, params, before, since, between=None, fields=None):
+  async for page in iter_item_pages(http, params, before, since, between, fields):
+    for pair in page:
+      yield pair
+
+async def get_item_list(http, params, before, since, between=None, fields=None):
+  return {item_id: item async for item_id, item in iter_item_list(http, params, before, since, between, fields)}
+
+# run func(items, *args) on a worker thread, where items are the pairs
+# from 'pages' (an async iterator of lists), handed over as they arrive
+# at most two pages wait for func at a time
+# returns whatever func returns
+async def plan_with(pages, func, *args):
+  loop = asyncio.get_event_loop()
+  handed_over = queue.Queue()
+  room = asyncio.Semaphore(2)
+  finished = object()
+
+  def items():
+    while True:
+      page = handed_over.get()
+      if page is finished:
+        return
+      loop.call_soon_threadsafe(room.release)
+      yield from page
+
+  planning = loop.run_in_executor(None, lambda: func(items(), *args))
+  try:
+    async for page in pages:
+      waiting = asyncio.ensure_future(room.acquire())
+      await asyncio.wait([waiting, planning], return_when=asyncio.FIRST_COMPLETED)
+      if not waiting.done():
+        # func has stopped (probably with an error) so nobody is reading
+        waiting.cancel()
+        break
+      handed_over.put(page)
+  finally:
+    handed_over.put(finished)
+  return await planning
+
+# --------------------
+# process tag updates
+# --------------------
+
+# send actions in batches, with up to send_workers batches in flight
+# returns a list of (batch, response, error) in the same order as the batches
+async def send_batches(http, actions, consumer_key, pocket_access_token):
+  limit = asyncio.Semaphore(max(1, pt.send_workers))
+
+  async def run(batch):
+    async with limit:
+      await take(pt.send_bucket)
+      return await send(http, batch, consumer_key, pocket_access_token)
+
+  batches = list(pt.pack_actions(actions))
+  results = await asyncio.gather(*[run(batch) for batch in batches], return_exceptions=True)
+  return [(batch, None, result) if isinstance(result, Exception) else (batch, result, None) for batch, result in zip(batches, results)]
+
+# returns how many actions failed to send
+async def process_items(http, actions, consumer_key, pocket_access_token):
+  failed = 0
+  for batch, response, error in await send_batches(http, actions, consumer_key, pocket_access_token):
+    if error is not None:
+      failed += len(batch)
+  return failed
+
+# run an operation within the command deadline
+# if Pocket can't be reached we say so rather than raising
+async def run_command(operation):
+  pt.start_command()
+  try:
+    return await operation()
+  except retry.PocketUnavailable as e:
+    return '  [highlight] Sorry, could not reach Pocket: ' + str(e) + ' [/highlight]'
+  except retry.PocketError as e:
+    return '  [highlight] Sorry, something went wrong talking to Pocket: ' + str(e) + ' [/highlight]'
+
+def failure_note(failed):
+  return ' [bold red on color(255)] ' + str(failed) + ' changes could not be sent. [/bold red on color(255)]' if failed else ''
+
+# ------------------------------
+# Read info about Pocket account
+# ------------------------------
+
+async def info(http, consumer_key, pocket_access_token, archive_tag, before, since, between=None):
+  pt.start_command()
+  params = pt.info_params(consumer_key, pocket_access_token, archive_tag)
+  return await get_item_list(http, params, before, since, between, pt.info_fields)
+
+async def info_stats(http, consumer_key, pocket_access_token, archive_tag, longreads_wordcount, before, since, between=None, top=10, fields=pt.info_stats_fields):
+  pt.start_command()
+  params = pt.info_params(consumer_key, pocket_access_token, archive_tag)
+  summary = pt.stats.ItemStats(longreads_wordcount, top)
+  async for item_id, item in iter_item_list(http, params, before, since, between, fields):
+    summary.add(item)
+  return summary.summary()
+
+# -----------------------------------
+# lucky dip from archive back to list
+# -----------------------------------
+
+async def lucky_dip(http, consumer_key, pocket_access_token, archive_tag, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount, before, since, between=None):
+
+  async def run_lucky_dip():
+    params = pt.lucky_dip_params(consumer_key, pocket_access_token, archive_tag)
+    pages = iter_item_pages(http, params, before, since, between, pt.lucky_dip_fields)
+    selection, chosen, available = await plan_with(pages, pt.choose_lucky_dip, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount)
+    if available == 0:
+      return '  [highlight] Nothing to be read! [/highlight]'
+    actions = pt.readd_actions(selection, archive_tag)
+    if pt.dry_run:
+      planner = pt.plan.Planner()
+      planner.count(actions)
+      return pt.dry_run_report(planner, actions)
+    failed = await process_items(http, actions, consumer_key, pocket_access_token)
+    return pt.lucky_dip_message(chosen, available, before, since, between) + failure_note(failed)
+
+  return await run_command(run_lucky_dip)
+
+# -----------------
+#  purge tags
+# -----------------
+
+async def purge_tags(http, state, retain_tags, archive_tag, consumer_key, pocket_access_token, before, since, between=None):
+
+  async def run_purge():
+    params = pt.purge_params(state, archive_tag, consumer_key, pocket_access_token)
+    planner = pt.plan.Planner()
+    pages = iter_item_pages(http, params, before, since, between, pt.purge_fields)
+    actions = await plan_with(pages, pt.purge_actions, retain_tags, archive_tag, planner)
+    if pt.dry_run:
+      return pt.dry_run_report(planner, actions)
+    if len(actions) == 0:
+      return '[highlight]  No items from which to purge tags. [/highlight]'
+    failed = await process_items(http, actions, consumer_key, pocket_access_token)
+    return '  [highlight] Undesirable elements have been purged. [/highlight]' + failure_note(failed)
+
+  return await run_command(run_purge)
+
+# -----------------
+# stash items
+# -----------------
+
+async def stash(http, consumer_key, pocket_access_token, archive_tag, replace_all_tags, retain_tags, favorite, ignore_tags, before, since, between=None):
+
+  async def run_stash():
+    params = pt.stash_params(consumer_key, pocket_access_token, favorite)
+    planner = pt.plan.Planner()
+    pages = iter_item_pages(http, params, before, since, between, pt.stash_fields)
+    actions, items_to_stash, total_items = await plan_with(pages, pt.stash_actions, archive_tag, replace_all_tags, retain_tags, ignore_tags, planner)
+    if pt.dry_run:
+      return pt.dry_run_report(planner, actions)
+    failed = await process_items(http, actions, consumer_key, pocket_access_token)
+    return pt.stash_message(archive_tag, items_to_stash, total_items) + failure_note(failed)
+
+  return await run_command(run_stash)
+
+# -----------------
+# de-duplicate
+# -----------------
+
+# there's nobody to type 'delete' inside an event loop, so duplicates
+# are only removed when delete is True - otherwise we just report them
+async def dedupe(http, state, tag, fave_dupes, consumer_key, pocket_access_token, delete=False, rules=None):
+
+  async def run_dedupe():
+    parameters = pt.dedupe_params(state, tag, consumer_key, pocket_access_token)
+    pages = iter_item_pages(http, parameters, False, False, None, pt.dedupe_fields)
+    checked, duplicates = await plan_with(pages, pt.find_duplicates, rules)
+    actions, faves = pt.dedupe_actions(duplicates, fave_dupes)
+    if len(actions) == 0:
+      return '  :party_popper: [highlight] No duplicates found! [/highlight]'
+    if pt.dry_run:
+      planner = pt.plan.Planner()
+      planner.count(faves)
+      planner.count(actions)
+      return pt.dry_run_report(planner, faves, actions)
+    if not delete:
+      return '  Found [highlight] ' + str(len(actions)) + ' [/highlight] duplicate items in [highlight] ' + str(checked) + ' [/highlight] items.'
+    failed = 0
+    if fave_dupes:
+      failed += await process_items(http, faves, consumer_key, pocket_access_token)
+    failed += await process_items(http, actions, consumer_key, pocket_access_token)
+    return '  :white_heavy_check_mark: [highlight] de-duping completed [/highlight]' + failure_note(failed)
+
+  return await run_command(run_dedupe)
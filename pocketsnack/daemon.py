@@ -0,0 +1,352 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+# local modules
+from pocketsnack import metrics
+from pocketsnack import store
+from pocketsnack import toolkit as pt
+
+# -----------------------------------------------------------
+# Daemon
+# -----------------------------------------------------------
+# 'pocketsnack --daemon' stays running and does the jobs you would
+# otherwise run from cron, on the schedule in the 'daemon' section of
+# your config file:
+#
+#   daemon:
+#     refresh: 900             # seconds between syncs with Pocket
+#     control: ~/.pocketsnack.sock
+#     jobs:
+#       stash: {at: "22:00"}   # every day at 10pm
+#       lucky_dip: {at: "06:30"}
+#
+# A job can also run 'every' so many seconds.
+#
+# Between jobs the daemon keeps its connections to Pocket open and a
+# local store (see store.py) up to date, so when a job runs it only
+# has to download what changed since the last refresh. If there's no
+# local_store in the config, a temporary one is used while the daemon
+# runs.
+#
+# Jobs run one at a time. The control socket accepts one line and
+# answers with one line of JSON:
+#
+#   status        what has run, what is running and what runs next
+#   run <job>     run a job (or 'refresh') as soon as possible
+#   stop          finish the current job and exit
+#
+# 'pocketsnack --control status' and friends send these for you.
+# control can be a path (a Unix socket) or host:port (TCP, for systems
+# without Unix sockets). Anyone who can connect to it can run jobs, so
+# the Unix socket is only readable by you, and TCP should stay on
+# 127.0.0.1.
+
+default_refresh = 900
+default_control = os.path.join('~', '.pocketsnack.sock') if hasattr(socket, 'AF_UNIX') else '127.0.0.1:8766'
+
+# the jobs that can be scheduled, as functions of the config settings
+def make_jobs(S):
+  consumer_key = S['pocket_consumer_key']
+  access_token = S['pocket_access_token']
+  archive_tag = S['archive_tag']
+  return {
+    'stash': lambda: pt.stash(
+      consumer_key,
+      access_token,
+      archive_tag,
+      S['replace_all_tags'],
+      set(S['retain_tags']),
+      S['ignore_faves'],
+      set(S['ignore_tags']),
+      False,
+      False
+      ),
+    'lucky_dip': lambda: pt.lucky_dip(
+      consumer_key,
+      access_token,
+      archive_tag,
+      S['items_per_cycle'],
+      S['num_videos'],
+      S['num_images'],
+      S['num_longreads'],
+      S['longreads_wordcount'],
+      False,
+      False
+      ),
+    'refresh': lambda: refresh(consumer_key, access_token),
+  }
+
+# bring the local store up to date
+def refresh(consumer_key, pocket_access_token):
+  pt.start_command()
+  conn, account = pt.sync_store(consumer_key, pocket_access_token)
+  try:
+    return '  Local store has [highlight] ' + str(store.count_items(conn, account)) + ' [/highlight] items.'
+  finally:
+    conn.close()
+
+# when a job should next run, after the time 'after'
+# a schedule is {'every': seconds} or {'at': 'HH:MM'} (every day, local time)
+def next_run(schedule, after):
+  if 'every' in schedule:
+    return after + float(schedule['every'])
+  hour, minute = (int(part) for part in str(schedule['at']).split(':'))
+  candidate = datetime.fromtimestamp(after).replace(hour=hour, minute=minute, second=0, microsecond=0)
+  if candidate.timestamp() <= after:
+    candidate += timedelta(days=1)
+  return candidate.timestamp()
+
+# read the 'daemon' section of the config file
+# returns {job: schedule}, and the control address
+def read_settings(S):
+  settings = S.get('daemon') or {}
+  jobs = make_jobs(S)
+  schedules = {}
+  for name, schedule in (settings.get('jobs') or {}).items():
+    if name not in jobs or name == 'refresh':
+      raise ValueError('pocketsnack --daemon cannot run ' + str(name))
+    if not isinstance(schedule, dict) or not ('every' in schedule or 'at' in schedule):
+      raise ValueError(str(name) + ' needs an "every" or "at" schedule')
+    next_run(schedule, time.time()) # check it makes sense now, not at 10pm
+    schedules[name] = schedule
+  schedules['refresh'] = {'every': settings.get('refresh') or default_refresh}
+  return schedules, settings.get('control') or default_control
+
+class Daemon:
+
+  def __init__(self, jobs, schedules, metrics_file=None):
+    self.jobs = jobs
+    self.schedules = schedules
+    self.metrics_file = metrics_file
+    self.started = time.time()
+    self.running = None
+    self.stopping = False
+    self.queued = []
+    self.condition = threading.Condition()
+    # refresh straight away so the first job starts warm
+    self.next = {name: next_run(schedule, self.started) for name, schedule in schedules.items()}
+    self.next['refresh'] = self.started
+    self.history = {name: {'runs': 0, 'last_run': None, 'seconds': None, 'result': None, 'error': None} for name in schedules}
+
+  # ask for a job to run as soon as the current one finishes
+  def trigger(self, name):
+    if name not in self.jobs:
+      raise KeyError(name)
+    with self.condition:
+      if name not in self.queued:
+        self.queued.append(name)
+      self.condition.notify()
+
+  def stop(self):
+    with self.condition:
+      self.stopping = True
+      self.condition.notify()
+
+  def status(self):
+    with self.condition:
+      return {
+        'started': self.started,
+        'running': self.running,
+        'queued': list(self.queued),
+        'jobs': {name: dict(self.history.get(name, {}), next_run=self.next.get(name)) for name in self.jobs if name in self.history or name in self.queued},
+      }
+
+  # wait for the next job that is due, or None if we're stopping
+  def wait_for_job(self):
+    with self.condition:
+      while not self.stopping:
+        if self.queued:
+          return self.queued.pop(0)
+        name = min(self.next, key=self.next.get)
+        delay = self.next[name] - time.time()
+        if delay <= 0:
+          return name
+        self.condition.wait(delay)
+      return None
+
+  def run_job(self, name):
+    with self.condition:
+      self.running = name
+      self.history.setdefault(name, {'runs': 0, 'last_run': None, 'seconds': None, 'result': None, 'error': None})
+    pt.console.print('  [highlight] ' + datetime.now().strftime('%Y-%m-%d %H:%M') + ' running ' + name + ' [/highlight]')
+    metrics.reset()
+    started = time.time()
+    result, error = None, None
+    try:
+      result = self.jobs[name]()
+      if result:
+        pt.console.print(result)
+    except Exception as e:
+      # one failed job shouldn't stop the next one
+      error = type(e).__name__ + ': ' + str(e)
+      pt.console.print('  [bold red on color(255)] ' + name + ' failed: ' + error + ' [/bold red on color(255)]')
+    if self.metrics_file:
+      metrics.write(self.metrics_file)
+    with self.condition:
+      self.running = None
+      history = self.history[name]
+      history['runs'] += 1
+      history['last_run'] = started
+      history['seconds'] = round(time.time() - started, 3)
+      history['result'] = result
+      history['error'] = error
+      if name in self.schedules:
+        self.next[name] = next_run(self.schedules[name], time.time())
+
+  def serve_forever(self):
+    while True:
+      name = self.wait_for_job()
+      if name is None:
+        return
+      self.run_job(name)
+
+# ----------------
+# Control socket
+# ----------------
+
+def is_tcp(address):
+  host, sep, port = address.rpartition(':')
+  return bool(sep) and port.isdigit() and os.sep not in address
+
+def make_server(address, daemon):
+
+  class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+      words = self.rfile.readline().decode('utf-8').split()
+      if words == ['status']:
+        reply = daemon.status()
+      elif len(words) == 2 and words[0] == 'run':
+        try:
+          daemon.trigger(words[1])
+          reply = {'queued': words[1]}
+        except KeyError:
+          reply = {'error': 'no job called ' + words[1] + ', try one of ' + ', '.join(sorted(daemon.jobs))}
+      elif words == ['stop']:
+        daemon.stop()
+        reply = {'stopping': True}
+      else:
+        reply = {'error': 'expected status, run <job> or stop'}
+      self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+  if is_tcp(address):
+    host, port = address.rsplit(':', 1)
+    server = socketserver.ThreadingTCPServer((host, int(port)), Handler)
+  else:
+    path = os.path.expanduser(address)
+    if os.path.exists(path):
+      # a socket left behind by a daemon that didn't shut down cleanly
+      try:
+        request(address, 'status')
+      except OSError:
+        os.unlink(path)
+      else:
+        raise OSError('a pocketsnack daemon is already listening on ' + path)
+    # the socket is created with these permissions, so nobody else can connect
+    umask = os.umask(0o177)
+    try:
+      server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+      os.umask(umask)
+  server.daemon_threads = True
+  return server
+
+# send one line to a running daemon and return its reply
+def request(address, message, timeout=10):
+  if is_tcp(address):
+    host, port = address.rsplit(':', 1)
+    sock = socket.create_connection((host, int(port)), timeout=timeout)
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(os.path.expanduser(address))
+  with sock:
+    sock.sendall(message.encode('utf-8') + b'\n')
+    reply = sock.makefile('rb').readline()
+  return json.loads(reply.decode('utf-8'))
+
+# ----------------
+# Running it
+# ----------------
+
+def when(timestamp):
+  return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M') if timestamp else 'never'
+
+# a status reply as a message for the console
+def status_message(status):
+  lines = ['  [highlight] pocketsnack daemon [/highlight] running since ' + when(status['started'])]
+  if status['running']:
+    lines.append('  Running [command] ' + status['running'] + ' [/command] now')
+  for name, job in sorted(status['jobs'].items()):
+    line = '  [command] ' + name + ' [/command] last ran ' + when(job['last_run'])
+    if job['seconds'] is not None:
+      line += ' (' + str(job['seconds']) + 's)'
+    if job['error']:
+      line += ' and failed: ' + job['error']
+    if job['next_run']:
+      line += ', next at ' + when(job['next_run'])
+    lines.append(line)
+  if status['queued']:
+    lines.append('  Waiting to run: ' + ', '.join(status['queued']))
+  return '\n'.join(lines)
+
+def run(S):
+  schedules, address = read_settings(S)
+  # without a store every job would download everything again
+  scratch = None
+  if not pt.local_store:
+    scratch = tempfile.mkdtemp(prefix='pocketsnack-')
+    pt.use_store(os.path.join(scratch, 'store.db'))
+
+  daemon = Daemon(make_jobs(S), schedules, S.get('metrics_file'))
+  server = make_server(address, daemon)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+
+  pt.console.print('  [highlight] pocketsnack daemon [/highlight] listening on ' + address)
+  for name in sorted(schedules):
+    pt.console.print('  [command] ' + name + ' [/command] next runs at ' + when(daemon.next[name]))
+  try:
+    daemon.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+    server.server_close()
+    if not is_tcp(address) and os.path.exists(os.path.expanduser(address)):
+      os.unlink(os.path.expanduser(address))
+    if scratch:
+      shutil.rmtree(scratch, ignore_errors=True)
+  return '  [highlight] pocketsnack daemon stopped. [/highlight]'
@@ -0,0 +1,187 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+# local modules
+from pocketsnack import metrics
+
+# -----------------------------------------------------------
+# Token bucket
+# -----------------------------------------------------------
+# Tokens drip into the bucket at 'rate' per second, up to 'burst'.
+# Every request takes one token, waiting if the bucket is empty.
+# This lets a short run go as fast as the burst allows, while a
+# long run settles at 'rate' requests per second.
+
+class TokenBucket:
+
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = max(1, int(burst))
+    self.tokens = float(self.burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  # take a token if there is one
+  # returns 0 on success, otherwise how many seconds until the next token
+  def try_take(self):
+    with self.lock:
+      self.refill()
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return 0
+      return (1 - self.tokens) / self.rate
+
+  # block until a token is available, then take it
+  def take(self):
+    wait = self.try_take()
+    while wait:
+      time.sleep(wait)
+      wait = self.try_take()
+
+# -----------------------------------------------------------
+# Rate limit scheduler
+# -----------------------------------------------------------
+# Pocket tells us how many calls we have left, for both the user and
+# the consumer key, in the X-Limit-* headers of every response.
+# While plenty remain we don't get in the way. Once we're down to the
+# last 'reserve' fraction of either limit, we spread what's left
+# evenly until the limit resets, so a long run never hits the wall.
+# A 403 with nothing remaining, or a 503, means back off: wait for
+# the reset if we know when it is, otherwise wait a little longer
+# after each failure.
+
+class RateLimitScheduler:
+
+  def __init__(self, reserve=0.2, max_backoff=300):
+    self.reserve = float(reserve)
+    self.max_backoff = max_backoff
+    self.interval = 0 # seconds between calls, 0 when we're not pacing
+    self.next_call = 0 # monotonic time of the next allowed call
+    self.failures = 0
+    self.limits = {}
+    self.lock = threading.Lock()
+
+  # how long the caller should wait before making its call
+  # each call reserves a slot, so concurrent callers are spaced out too
+  # returns None, without reserving anything, if that's longer than 'limit' seconds
+  def reserve_slot(self, limit=None):
+    with self.lock:
+      now = time.monotonic()
+      start = max(now, self.next_call)
+      if limit is not None and start - now > limit:
+        return None
+      self.next_call = start + self.interval
+      return start - now
+
+  # returns False straight away if our turn won't come within 'limit' seconds
+  def wait(self, limit=None):
+    delay = self.reserve_slot(limit)
+    if delay is None:
+      return False
+    if delay > 0:
+      time.sleep(delay)
+    return True
+
+  # read the X-Limit-* headers for 'User' and 'Key'
+  def read_limits(self, headers):
+    limits = {}
+    for scope in ('User', 'Key'):
+      try:
+        limit = int(headers['X-Limit-' + scope + '-Limit'])
+        remaining = int(headers['X-Limit-' + scope + '-Remaining'])
+        reset = int(headers['X-Limit-' + scope + '-Reset'])
+      except (KeyError, TypeError, ValueError):
+        continue
+      limits[scope] = (limit, remaining, reset)
+    return limits
+
+  # true if the response means we've been throttled and should try again
+  def throttled(self, status, headers):
+    if status == 503:
+      return True
+    if status == 403:
+      # a 403 is also Pocket's answer to a bad token, so only treat it
+      # as throttling if a limit has actually run out
+      return any(remaining <= 0 for limit, remaining, reset in self.read_limits(headers).values())
+    return False
+
+  # update our pace after every response
+  def update(self, status, headers):
+    limits = self.read_limits(headers)
+    with self.lock:
+      if limits:
+        self.limits = limits
+      interval = 0
+      for limit, remaining, reset in limits.values():
+        if remaining <= limit * self.reserve:
+          interval = max(interval, reset / max(remaining, 1))
+      self.interval = interval
+
+      if self.throttled(status, headers):
+        self.failures += 1
+        exhausted = [reset for limit, remaining, reset in limits.values() if remaining <= 0]
+        backoff = max(exhausted) if exhausted else min(self.max_backoff, 2 ** self.failures)
+        self.next_call = max(self.next_call, time.monotonic() + backoff)
+      elif status < 400:
+        self.failures = 0
+
+# -----------------------------------------------------------
+# Dispatcher
+# -----------------------------------------------------------
+# Run func(batch) for every batch on a small pool of worker threads,
+# with each call waiting for a token from the bucket first.
+# Results are yielded in the same order as the batches, as
+# (batch, result, error) tuples - error is None if func succeeded.
+# If the caller stops early, batches that haven't started are cancelled.
+
+def dispatch(batches, func, workers, bucket):
+
+  def run(batch):
+    with metrics.timer('token bucket wait'):
+      bucket.take()
+    return func(batch)
+
+  pool = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+  futures = []
+  try:
+    for batch in batches:
+      futures.append((batch, pool.submit(run, batch)))
+    for batch, future in futures:
+      try:
+        yield batch, future.result(), None
+      except Exception as e:
+        yield batch, None, e
+  finally:
+    for batch, future in futures:
+      future.cancel()
+    pool.shutdown(wait=True)
@@ -0,0 +1,149 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import sys
+
+# -----------------------------------------------------------
+# Items
+# -----------------------------------------------------------
+# Pocket sends a lot more about each item than we ever look at:
+# excerpts, authors, images, domain metadata and so on, all as strings
+# in a dict. An Item keeps just the fields pocketsnack uses, in slots
+# rather than a dict, with numbers as numbers and tag names shared
+# between items. This is what every toolkit operation works with.
+#
+#   status      0 = in the list, 1 = archived, 2 = deleted
+#   has_video   0 = none, 1 = has videos, 2 = is a video (same for has_image)
+#   favorite    0 or 1
+#   tags        a tuple of tag names
+#
+# Most commands only look at a few of these, so they say which fields
+# they need. We then ask Pocket for the lightest detailType that has
+# them, and fill in just those fields: the rest keep their defaults.
+
+# Pocket sends strings for nearly everything, and sometimes nothing at all
+def as_int(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return 0
+
+def as_text(value):
+  return value or ''
+
+# tag names are shared between items, so each name is only stored once
+def as_tags(value):
+  return tuple(sys.intern(tag) for tag in value or ())
+
+converters = {
+  'given_url': as_text,
+  'resolved_url': as_text,
+  'tags': as_tags,
+  'word_count': as_int,
+  'has_video': as_int,
+  'has_image': as_int,
+  'time_added': as_int,
+  'time_updated': as_int,
+  'favorite': as_int,
+  'status': as_int,
+}
+all_fields = frozenset(converters)
+
+# what each detailType includes, lightest first
+# Pocket only sends tags (and authors, images etc) with 'complete'
+detail_types = [
+  ('simple', all_fields - {'tags'}),
+  ('complete', all_fields),
+]
+
+# the lightest detailType that includes all of 'fields'
+def detail_type(fields):
+  for name, provided in detail_types:
+    if provided.issuperset(fields):
+      return name
+  raise ValueError('no detailType includes ' + ', '.join(sorted(set(fields) - all_fields)))
+
+class Item:
+
+  __slots__ = ('item_id', 'given_url', 'resolved_url', 'tags', 'word_count', 'has_video', 'has_image', 'time_added', 'time_updated', 'favorite', 'status')
+
+  def __init__(self, item_id, given_url='', resolved_url='', tags=(), word_count=0, has_video=0, has_image=0, time_added=0, time_updated=0, favorite=0, status=0):
+    self.item_id = item_id
+    self.given_url = given_url
+    self.resolved_url = resolved_url
+    self.tags = tags
+    self.word_count = word_count
+    self.has_video = has_video
+    self.has_image = has_image
+    self.time_added = time_added
+    self.time_updated = time_updated
+    self.favorite = favorite
+    self.status = status
+
+  # make an Item from one entry in the 'list' Pocket sends back
+  # with 'fields', only those are read and everything else is left out
+  @classmethod
+  def from_json(cls, item_id, data, fields=None):
+    if fields is not None:
+      item = cls(item_id)
+      for name in fields:
+        setattr(item, name, converters[name](data.get(name)))
+      return item
+    return cls(
+      item_id,
+      data.get('given_url') or '',
+      data.get('resolved_url') or '',
+      as_tags(data.get('tags')),
+      as_int(data.get('word_count')),
+      as_int(data.get('has_video')),
+      as_int(data.get('has_image')),
+      as_int(data.get('time_added')),
+      as_int(data.get('time_updated')),
+      as_int(data.get('favorite')),
+      as_int(data.get('status'))
+      )
+
+  # the same fields with Pocket's names, for from_json to read back later
+  def to_json(self):
+    return {
+      'given_url': self.given_url,
+      'resolved_url': self.resolved_url,
+      'tags': list(self.tags),
+      'word_count': self.word_count,
+      'has_video': self.has_video,
+      'has_image': self.has_image,
+      'time_added': self.time_added,
+      'time_updated': self.time_updated,
+      'favorite': self.favorite,
+      'status': self.status,
+    }
+
+  # generally we want to use the 'resolved url' but sometimes that might not exist
+  # if so, use the 'given url' instead
+  @property
+  def url(self):
+    return self.resolved_url or self.given_url
+
+  def __repr__(self):
+    return '<Item ' + str(self.item_id) + ' ' + self.url + '>'
@@ -0,0 +1,98 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import json
+import sqlite3
+import time
+
+# -----------------------------------------------------------
+# Action journal
+# -----------------------------------------------------------
+# Before a command sends any changes to Pocket, every batch it plans
+# to send is written here. Each batch is marked done once Pocket has
+# accepted it (or refused it outright, since sending it again won't
+# help), and the run is removed when every batch is done. If a
+# command is interrupted (Ctrl-C, a dropped connection, Pocket being
+# down) its run stays in the journal, and 'pocketsnack --resume' sends
+# only the batches that were never accepted.
+#
+# A batch that was on its way when the command stopped may be sent
+# again, but every action pocketsnack sends is safe to repeat.
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+  run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  account TEXT NOT NULL,
+  command TEXT,
+  created INTEGER
+);
+CREATE TABLE IF NOT EXISTS batches (
+  run_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  actions TEXT NOT NULL,
+  done INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (run_id, seq)
+);
+"""
+
+# several accounts can share one journal, so wait a while if another is writing
+def connect(path):
+  conn = sqlite3.connect(path, timeout=60)
+  conn.executescript(schema)
+  return conn
+
+# write every batch of a new run, all in one transaction
+# returns the run id and a list of (seq, batch)
+def start_run(conn, account, command, batches):
+  planned = list(enumerate(batches))
+  with conn:
+    run_id = conn.execute('INSERT INTO runs (account, command, created) VALUES (?, ?, ?)', (account, command, int(time.time()))).lastrowid
+    conn.executemany(
+      'INSERT INTO batches (run_id, seq, actions) VALUES (?, ?, ?)',
+      [(run_id, seq, json.dumps(batch)) for seq, batch in planned]
+      )
+  return run_id, planned
+
+def mark_done(conn, run_id, seq):
+  with conn:
+    conn.execute('UPDATE batches SET done = 1 WHERE run_id = ? AND seq = ?', (run_id, seq))
+
+# remove the run if everything in it has been sent
+# returns True if it was removed
+def finish_run(conn, run_id):
+  with conn:
+    if conn.execute('SELECT COUNT(*) FROM batches WHERE run_id = ? AND done = 0', (run_id,)).fetchone()[0]:
+      return False
+    conn.execute('DELETE FROM batches WHERE run_id = ?', (run_id,))
+    conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+  return True
+
+# unfinished runs for an account as (run_id, command, created), oldest first
+def unfinished_runs(conn, account):
+  return conn.execute('SELECT run_id, command, created FROM runs WHERE account = ? ORDER BY run_id', (account,)).fetchall()
+
+# the batches of a run that still need sending, as (seq, batch)
+def pending_batches(conn, run_id):
+  rows = conn.execute('SELECT seq, actions FROM batches WHERE run_id = ? AND done = 0 ORDER BY seq', (run_id,))
+  return [(seq, json.loads(actions)) for seq, actions in rows]
@@ -0,0 +1,183 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import codecs
+import json
+import re
+
+# local modules
+from pocketsnack import metrics
+from pocketsnack import retry
+
+# -----------------------------------------------------------
+# Streaming JSON
+# -----------------------------------------------------------
+# A page from /v3/get is one big JSON object, almost all of it the
+# 'list' of items. Rather than download the whole thing and decode it
+# in one go (holding the bytes, the text and every decoded item at
+# once), we decode it as it arrives and hand over each item as soon as
+# it's complete. Only the part of the page that hasn't been decoded yet
+# is kept.
+#
+# Each item is decoded with the standard json module. This file only
+# finds where each item starts and ends.
+
+whitespace = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+# raised when we need more of the response before we can go on
+class Incomplete(Exception):
+  pass
+
+# raised when the response stops part way through or isn't the JSON we
+# expected. It's Pocket's problem rather than the config's, so it's a
+# retry.PocketError like any other failed request
+class BrokenResponse(retry.PocketError):
+  pass
+
+class Reader:
+
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.utf8 = codecs.getincrementaldecoder('utf-8')()
+    self.text = ''
+    self.pos = 0
+    self.eof = False
+
+  # read the next chunk, dropping everything already decoded
+  def more(self):
+    if self.eof:
+      raise BrokenResponse('the response ended part way through')
+    self.text = self.text[self.pos:]
+    self.pos = 0
+    with metrics.timer('download'):
+      chunk = next(self.chunks, None)
+    try:
+      if chunk is None:
+        self.eof = True
+        self.text += self.utf8.decode(b'', final=True)
+      else:
+        self.text += self.utf8.decode(chunk)
+    except UnicodeDecodeError as e:
+      raise BrokenResponse('the response is not UTF-8: ' + str(e)) from e
+
+  # the next character that isn't whitespace, without taking it
+  def peek(self):
+    self.pos = whitespace.match(self.text, self.pos).end()
+    if self.pos == len(self.text):
+      if self.eof:
+        raise BrokenResponse('the response ended part way through')
+      raise Incomplete()
+    return self.text[self.pos]
+
+  def take(self, expected):
+    if self.peek() != expected:
+      raise BrokenResponse('expected ' + expected + ' at ' + repr(self.text[self.pos:self.pos + 20]))
+    self.pos += 1
+
+  def value(self):
+    self.peek()
+    try:
+      value, end = decoder.raw_decode(self.text, self.pos)
+    except json.JSONDecodeError as e:
+      if self.eof:
+        raise BrokenResponse('the response is not valid JSON: ' + str(e)) from e
+      raise Incomplete()
+    # a number at the very end might carry on in the next chunk
+    if end == len(self.text) and not self.eof:
+      raise Incomplete()
+    self.pos = end
+    return value
+
+  # do step(), reading more of the response until there's enough
+  def wait(self, step, *args):
+    start = self.pos
+    while True:
+      try:
+        return step(*args)
+      except Incomplete:
+        self.pos = start
+        self.more()
+        start = self.pos
+
+  # yield lists of (name, value) from the object at the current position,
+  # as many as we have the text for each time
+  # with 'convert', each value is replaced by convert(name, value) straight away
+  def members(self, convert=None):
+    self.wait(self.take, '{')
+    if self.wait(self.peek) == '}':
+      self.pos += 1
+      return
+    while True:
+      batch = []
+      finished = False
+      with metrics.timer('decode json'):
+        try:
+          while True:
+            start = self.pos
+            name = self.value()
+            self.take(':')
+            value = self.value()
+            separator = self.peek()
+            if separator not in ',}':
+              raise BrokenResponse('expected , or } at ' + repr(self.text[self.pos:self.pos + 20]))
+            self.pos += 1
+            batch.append((name, convert(name, value) if convert else value))
+            if separator == '}':
+              finished = True
+              break
+        except Incomplete:
+          # go back to the start of the member we didn't finish
+          self.pos = start
+      yield batch
+      if finished:
+        return
+      self.more()
+
+# yield (name, value) for each member of the object at 'key' in a JSON
+# object arriving as 'chunks' of bytes, as soon as each one is complete
+# every other member of the outer object is put in 'fields'
+# values can be converted as they're decoded (see Reader.members)
+def iter_members(chunks, key, fields, convert=None):
+  reader = Reader(chunks)
+  reader.wait(reader.take, '{')
+  if reader.wait(reader.peek) == '}':
+    return
+  while True:
+    name = reader.wait(reader.value)
+    reader.wait(reader.take, ':')
+    if name == key and reader.wait(reader.peek) == '{':
+      for batch in reader.members(convert):
+        yield from batch
+    elif name == key:
+      # Pocket sends [] for an empty list
+      reader.wait(reader.value)
+    else:
+      fields[name] = reader.wait(reader.value)
+    separator = reader.wait(reader.peek)
+    reader.pos += 1
+    if separator == '}':
+      return
+    if separator != ',':
+      raise BrokenResponse('expected , or } after ' + repr(name))
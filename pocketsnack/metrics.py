@@ -0,0 +1,180 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import json
+import os
+import tempfile
+import threading
+import time
+
+# -----------------------------------------------------------
+# Timings and counters
+# -----------------------------------------------------------
+# The toolkit wraps each phase of its work in a timer: the HTTP calls,
+# decoding JSON, waiting for the rate limit scheduler or the token
+# bucket, backing off before a retry, choosing items, building actions.
+#
+# Timers can be nested, and each one records only its own time, not
+# the time spent in timers inside it. Choosing lucky dip items pulls
+# pages from Pocket as it goes, so 'select' is the time spent choosing
+# and 'http /get' is the time spent waiting for Pocket. Add them up and
+# you get the time the command took.
+#
+# Each thread keeps its own stack of timers. Batches are sent by several
+# threads at once, so the send timers can add up to more than the time
+# the command took.
+#
+# Counters keep track of requests, bytes, items, actions and retries.
+
+lock = threading.Lock()
+local = threading.local()
+timers = {} # name -> [seconds, calls]
+counters = {}
+started = time.time()
+
+def reset():
+  global started
+  with lock:
+    timers.clear()
+    counters.clear()
+    started = time.time()
+
+def count(name, amount=1):
+  with lock:
+    counters[name] = counters.get(name, 0) + amount
+
+class timer:
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+      stack = local.stack = []
+    self.start = time.perf_counter()
+    self.inner = 0 # time spent in timers inside this one
+    stack.append(self)
+    return self
+
+  def __exit__(self, *exc):
+    elapsed = time.perf_counter() - self.start
+    stack = local.stack
+    stack.pop()
+    if stack:
+      stack[-1].inner += elapsed
+    with lock:
+      totals = timers.setdefault(self.name, [0.0, 0])
+      totals[0] += elapsed - self.inner
+      totals[1] += 1
+    return False
+
+# ----------------
+# Reporting
+# ----------------
+
+def snapshot():
+  with lock:
+    return {
+      'wall_seconds': round(time.time() - started, 3),
+      'phases': {name: {'seconds': round(seconds, 4), 'calls': calls} for name, (seconds, calls) in sorted(timers.items(), key=lambda pair: -pair[1][0])},
+      'counters': dict(sorted(counters.items())),
+    }
+
+# for --timings
+def summary():
+  data = snapshot()
+  lines = ['  [highlight] Timings [/highlight] (' + str(data['wall_seconds']) + ' seconds altogether)']
+  for name, phase in data['phases'].items():
+    lines.append('    {:<20} {:>10.3f}s {:>8} calls'.format(name, phase['seconds'], phase['calls']))
+  for name, value in data['counters'].items():
+    lines.append('    {:<20} {:>11}'.format(name, value))
+  return '\n'.join(lines)
+
+# with 'account', the figures are labelled with the account they're for
+def as_json(account=None):
+  data = snapshot()
+  if account:
+    data['account'] = account
+  return json.dumps(data, indent=2)
+
+# the Prometheus text format, for node exporter's textfile collector
+def prometheus_name(name):
+  return '_'.join(''.join(c if c.isalnum() else ' ' for c in name).split())
+
+# {name="value",...} for a metric, leaving out any that are None
+def prometheus_labels(**labels):
+  pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in sorted(labels.items()) if value is not None]
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+# with 'account', every metric has an account label, so the files for
+# several accounts can sit side by side in the collector's directory
+def as_prometheus(account=None):
+  data = snapshot()
+  lines = [
+    '# HELP pocketsnack_phase_seconds Seconds spent in each phase of the last pocketsnack run.',
+    '# TYPE pocketsnack_phase_seconds gauge',
+    ]
+  for name, phase in data['phases'].items():
+    lines.append('pocketsnack_phase_seconds' + prometheus_labels(account=account, phase=name) + ' ' + str(phase['seconds']))
+  lines += [
+    '# HELP pocketsnack_phase_calls How many times each phase ran in the last pocketsnack run.',
+    '# TYPE pocketsnack_phase_calls gauge',
+    ]
+  for name, phase in data['phases'].items():
+    lines.append('pocketsnack_phase_calls' + prometheus_labels(account=account, phase=name) + ' ' + str(phase['calls']))
+  labels = prometheus_labels(account=account)
+  for name, value in data['counters'].items():
+    metric = 'pocketsnack_' + prometheus_name(name)
+    lines.append('# TYPE ' + metric + ' gauge')
+    lines.append(metric + labels + ' ' + str(value))
+  lines += [
+    '# TYPE pocketsnack_wall_seconds gauge',
+    'pocketsnack_wall_seconds' + labels + ' ' + str(data['wall_seconds']),
+    '# TYPE pocketsnack_last_run_timestamp_seconds gauge',
+    'pocketsnack_last_run_timestamp_seconds' + labels + ' ' + str(int(time.time())),
+    ]
+  return '\n'.join(lines) + '\n'
+
+# 'metrics.prom' becomes 'metrics.work.prom' for the account called 'work'
+def account_path(path, account):
+  root, extension = os.path.splitext(path)
+  return root + '.' + prometheus_name(account) + extension
+
+# write the metrics to a file: Prometheus format if it ends in .prom, otherwise JSON
+# the file is replaced in one go so a collector never reads half of it
+# the partial file has a name of its own, so several processes can write at once
+def write(path, account=None):
+  path = os.path.expanduser(path)
+  text = as_prometheus(account) if path.endswith('.prom') else as_json(account) + '\n'
+  handle, partial = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+  try:
+    with os.fdopen(handle, 'w') as metrics_file:
+      metrics_file.write(text)
+    # mkstemp only lets us read it, but the collector may run as someone else
+    os.chmod(partial, 0o644)
+    os.replace(partial, path)
+  except BaseException:
+    os.unlink(partial)
+    raise
@@ -0,0 +1,101 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from collections import Counter
+
+# -----------------------------------------------------------
+# Planning
+# -----------------------------------------------------------
+# Before an action is sent we compare what it would do with the item
+# as it is now. Adding a tag the item already has, archiving something
+# already archived, or replacing tags with the same tags changes
+# nothing, so there's no point spending an API call (and rate limit)
+# on it. Run the same stash twice and the second run sends almost nothing.
+#
+# A Planner decides which actions are worth sending and counts both
+# those and the ones it dropped, which is what --dry-run reports.
+
+# the tags in an action, which Pocket accepts as a list or a comma separated string
+def action_tags(action):
+  tags = action.get('tags') or []
+  if isinstance(tags, str):
+    tags = tags.split(',')
+  return set(tag.strip() for tag in tags if tag.strip())
+
+# would this action leave the item (an items.Item) exactly as it is?
+def is_noop(action, item):
+  kind = action['action']
+  if kind == 'tags_add':
+    return action_tags(action).issubset(item.tags)
+  if kind == 'tags_remove':
+    return action_tags(action).isdisjoint(item.tags)
+  if kind == 'tags_replace':
+    return action_tags(action) == set(item.tags)
+  if kind == 'tags_clear':
+    return len(item.tags) == 0
+  if kind == 'archive':
+    return item.status == 1
+  if kind == 'readd':
+    return item.status == 0
+  if kind == 'favorite':
+    return item.favorite == 1
+  if kind == 'unfavorite':
+    return item.favorite == 0
+  return False
+
+class Planner:
+
+  def __init__(self):
+    self.planned = Counter()
+    self.skipped = Counter()
+
+  # should this action be sent? False if it would change nothing
+  # item can be None if we don't know the item's current state
+  def keep(self, action, item=None):
+    if item is not None and is_noop(action, item):
+      self.skipped[action['action']] += 1
+      return False
+    self.planned[action['action']] += 1
+    return True
+
+  # count actions that are always needed
+  def count(self, actions):
+    for action in actions:
+      self.planned[action['action']] += 1
+    return actions
+
+  # what --dry-run prints instead of sending anything
+  def report(self, batches):
+    message = '  [highlight] Dry run: [/highlight] nothing has been sent to Pocket.\n'
+    if self.planned:
+      message += '  Would send [highlight] ' + str(sum(self.planned.values())) + ' [/highlight] actions in [highlight] ' + str(batches) + ' [/highlight] requests:\n'
+      for kind, count in sorted(self.planned.items()):
+        message += '    ' + kind + ': ' + str(count) + '\n'
+    else:
+      message += '  There is nothing to send.\n'
+    if self.skipped:
+      message += '  Skipped [highlight] ' + str(sum(self.skipped.values())) + ' [/highlight] actions that would not change anything:\n'
+      for kind, count in sorted(self.skipped.items()):
+        message += '    ' + kind + ': ' + str(count) + '\n'
+    return message.rstrip('\n')
@@ -23,43 +23,164 @@
 # Import libraries
 # ----------------
 
-from argparse import ArgumentParser
-from rich.console import Console
-from rich.theme import Theme
-import yaml
-
 # bundled with Python
+from argparse import ArgumentParser, ArgumentTypeError
+from datetime import datetime
 import os
-import pkg_resources
-import subprocess
-
-# local modules
-from pocketsnack import toolkit as pt
 
-# set up rich
-custom_theme = Theme({
-    "highlight" : "color(255) on cyan",
-    "command": "red on white"
-})
-console = Console(theme=custom_theme, highlight=False)
+# requests, rich and yaml take a while to load, so they (and the toolkit,
+# which uses all three) are only imported once there is work to do
+# --version and --help never need them
 
 # define config filepath for all platforms
 conf_file_path = os.path.join('~', '.pocketsnack_conf.yml')
 config_file = os.path.expanduser(conf_file_path)
 
+# check --between dates are real dates before we do anything with them
+def iso_date(value):
+  try:
+    datetime.strptime(value, '%Y-%m-%d')
+  except ValueError:
+    raise ArgumentTypeError(value + ' is not a date like 2021-03-31')
+  return value
+
+# version number from package info
+def get_version():
+  try:
+    from importlib.metadata import version, PackageNotFoundError
+  except ImportError:
+    # Python 3.6 and 3.7 don't have importlib.metadata
+    import pkg_resources
+    return pkg_resources.require("pocketsnack")[0].version
+  try:
+    return version("pocketsnack")
+  except PackageNotFoundError:
+    return 'unknown (not installed)'
+
+# ----------------
+# argparser arguments
+# ----------------
+
+def make_parser():
+
+  parser = ArgumentParser(description='pocketsnack: KonMari your Pocket tsundoku from the command line')
+  admin = parser.add_argument_group('admin commands')
+  actions = parser.add_argument_group('action commands')
+  mex = parser.add_mutually_exclusive_group()
+  timers = parser.add_mutually_exclusive_group()
+
+  mex.add_argument(
+      "-a", "--archive", action="store_true", help="get information on TBR items in archive (with -i) or purge tags in archive (with -p)"
+  )
+  mex.add_argument(
+      "-b", "--all", action="store_true", help="purge all tags in both list and archive (with -p) or dedupe both list and archive (with --dedupe)"
+  )
+  actions.add_argument(
+      "-c", "--config", action="store_true", help="create or edit your config file stored at ~/.pocketsnack_conf.yml"
+  )
+  admin.add_argument(
+      "--control", nargs='+', metavar='COMMAND', help="send a command to a running --daemon: 'status', 'run stash', 'run lucky_dip', 'run refresh' or 'stop'"
+  )
+  actions.add_argument(
+      "--daemon", action="store_true", help="keep running, doing the jobs in the 'daemon' section of your config file on schedule"
+  )
+  actions.add_argument(
+      "-d", "--lucky_dip", action="store_true", help="move random items tagged 'tbr' from archive to list, depending on config"
+  )
+  parser.add_argument(
+      "--dry-run", action="store_true", help="with --stash, --purge, --lucky_dip or --dedupe, show what would be sent to Pocket without changing anything"
+  )
+  actions.add_argument(
+      "--dedupe", action="store_true", help="de-duplicate list (-l), archive (-a), tbr items (--tbr) or all (-b). Defaults to list"
+  )
+  actions.add_argument(
+      "-i", "--info", action="store_true", help="get information on items in list or TBR items in archive"
+  )
+  parser.add_argument(
+      "--output", choices=['text', 'json', 'ndjson'], help="with --info, print statistics as text (the default), JSON, or NDJSON with one line per figure"
+  )
+  mex.add_argument(
+      "-l", "--list", action="store_true", help="get information on items in list (with -i) or purge tags in list (with -p)"
+  )
+  parser.add_argument(
+      "--metrics-file", metavar='FILE', help="write timings and request counts to FILE when the command finishes: a Prometheus textfile if FILE ends in .prom, otherwise JSON"
+  )
+  timers.add_argument(
+      "-n", "--since", type=int, help="only act on items where last activity is newer than a given number of days. Use with any action command"
+  )
+  timers.add_argument(
+      "-o", "--before", type=int, help="only act on items where last activity is older than a given number of days. Use with any action command"
+  )
+  timers.add_argument(
+      "--between", nargs=2, type=iso_date, metavar=('START', 'END'), help="only act on items where last activity is between two dates (YYYY-MM-DD), including both. Use with any action command"
+  )
+  parser.add_argument(
+      "--parallel", type=int, metavar='N', help="with several accounts in your config file, run at most N of them at once (default 4)"
+  )
+  actions.add_argument(
+      "-p", "--purge", action="store_true", help="remove all tags from list, archive, or both, depending on the second argument provided and excepting tags listed in 'retain_tags' in config"
+  )
+  actions.add_argument(
+      "--resume", action="store_true", help="send any changes left unsent when an earlier --stash, --purge or --lucky_dip was interrupted"
+  )
+  actions.add_argument(
+      "-s", "--stash", action="store_true", help="add 'tbr' tag to all items in user list and archive them, with exceptions as per config"
+  )
+  admin.add_argument(
+      "-t", "--test", action="store_true", help="test whether API call returns data"
+  )
+  mex.add_argument(
+      "--tbr", action="store_true", help="used in conjuction with --dedupe to dedupe only items in the tbr archive"
+  )
+  parser.add_argument(
+      "--timings", action="store_true", help="print how long each part of the command took, and how many requests, bytes, items and actions it handled"
+  )
+  admin.add_argument(
+      "-u", "--authorise", action="store_true", help="authorise app to connect to a Pocket account"
+  )
+  admin.add_argument(
+      "-v", "--version", action="store_true", help="print the current version number to screen"
+  )
+
+  return parser
+
   # ----------------
   # What happens with each command?
   # ----------------
 
-def main():
+def run(options, S):
+
+  from rich.console import Console
+  from pocketsnack import toolkit as pt
+
+  console = pt.console
+  # --timings goes to stderr so it never gets mixed up with --output json
+  err_console = Console(theme=pt.custom_theme, highlight=False, stderr=True)
+
+  # ----------------
+  # Settings
+  # ----------------
+
+  # assign short variable names from the config file
+  access_token = S['pocket_access_token']
+  consumer_key = S['pocket_consumer_key']
+  archive_tag = S['archive_tag']
+  ignore_tags = set(S['ignore_tags'])
+  retain_tags = set(S['retain_tags'])
+
+  # optional tuning: local store, page size etc
+  pt.configure(S)
+
 
   try:
 
+    pt.set_dry_run(options.dry_run)
+
     # Find all args that have a value other than False
     # This helps with error messages for optional args 
     # that need to be used in combination with something else
     true_vars = []
-    orphans = ['list', 'archive', 'all', 'since', 'before']
+    orphans = ['list', 'archive', 'all', 'since', 'before', 'between', 'output', 'dry_run', 'timings', 'metrics_file', 'parallel']
     for x in vars(options):
       if vars(options)[x]:
         true_vars.append(x)
@@ -86,7 +207,7 @@ def main():
       
       location = tag if tag else state if state != 'unread' else 'list'
       console.print('  [highlight] Checking for duplicates in ' + location + ' [/highlight]')
-      pt.dedupe(state, tag, S['fave_dupes'], consumer_key, access_token)
+      pt.dedupe(state, tag, S['fave_dupes'], consumer_key, access_token, S.get('dedupe_rules'))
 
     elif options.lucky_dip:
       console.print('  [highlight] Running lucky dip... [/highlight]')
@@ -100,44 +221,44 @@ def main():
         S['num_longreads'], 
         S['longreads_wordcount'], 
         options.before, 
-        options.since)
+        options.since,
+        options.between)
       console.print(dip)
 
     elif options.info:
 
-      def print_info(response, collection):
-        items = str(len(response))
-        longreads = 0
-        for item in response:
-          # is it a long read?
-          if 'word_count' in response[item]:
-            words = int(response[item]['word_count'])
-            longread = True if  words > S['longreads_wordcount'] else False
-          else:
-            longread = False
-          if longread:
-            longreads += 1
+      def print_info(summary, collection):
+        if options.output == 'json':
+          print(pt.stats.as_json(summary))
+          return
+        if options.output == 'ndjson':
+          print(pt.stats.as_ndjson(summary, S.get('account_name')))
+          return
+        if summary['items'] == 0:
+          console.print('  No items match that query')
+          return
+        items = str(summary['items'])
+        longreads = summary['longreads']
 
         if options.before:
           console.print(collection + 'has ' + items + ' items ' + 'updated prior to ' + str(options.before) + ' days ago and ' + str(longreads) + ' are longreads.')
         elif options.since:
           console.print(collection + 'has [highlight] ' + items + ' [/highlight] items ' + 'updated since ' + str(options.since) + ' days ago and ' + str(longreads) + ' are longreads.')
+        elif options.between:
+          console.print(collection + 'has [highlight] ' + items + ' [/highlight] items ' + 'updated between ' + options.between[0] + ' and ' + options.between[1] + ' and ' + str(longreads) + ' are longreads.')
         else:
           console.print(collection + 'has [highlight] ' + items + ' [/highlight] items and [highlight] ' + str(longreads) + ' [/highlight] are longreads.')
 
+      # the text only needs the counts, which don't need tags (or the complete details)
+      fields = pt.info_stats_fields if options.output in ('json', 'ndjson') else pt.info_fields
+
       if options.archive:
-        response = pt.info(consumer_key, access_token, archive_tag, options.before, options.since)
-        if len(response) > 0:
-          print_info(response, '  The TBR archive ')
-        else:
-          console.print('  No items match that query')
+        summary = pt.info_stats(consumer_key, access_token, archive_tag, S['longreads_wordcount'], options.before, options.since, options.between, fields=fields)
+        print_info(summary, '  The TBR archive ')
 
       elif options.list:
-        response = pt.info(consumer_key, access_token, False, options.before, options.since)
-        if len(response) > 0:
-          print_info(response, '  The user List ')
-        else:
-          console.print('  No items match that query')
+        summary = pt.info_stats(consumer_key, access_token, False, S['longreads_wordcount'], options.before, options.since, options.between, fields=fields)
+        print_info(summary, '  The user List ')
 
       else:
         console.print('\n [command] --info [/command] requires a second argument ([command]-a[/command] or [command]-l[/command]). Check [command] pocketsnack --help [/command] for more information\n')
@@ -153,7 +274,8 @@ def main():
           consumer_key, 
           access_token, 
           options.before, 
-          options.since
+          options.since,
+          options.between
           )
         console.print(purge)
 
@@ -166,7 +288,8 @@ def main():
           consumer_key, 
           access_token, 
           options.before, 
-          options.since
+          options.since,
+          options.between
           )
         console.print(purge)
 
@@ -179,7 +302,8 @@ def main():
           consumer_key, 
           access_token, 
           options.before, 
-          options.since
+          options.since,
+          options.between
           )
         console.print(purge)
 
@@ -192,7 +316,8 @@ def main():
           consumer_key, 
           access_token, 
           options.before, 
-          options.since
+          options.since,
+          options.between
           )
         console.print(purge)
 
@@ -209,18 +334,40 @@ def main():
         S['ignore_faves'], 
         ignore_tags, 
         options.before, 
-        options.since)
+        options.since,
+        options.between)
       console.print(stash)
 
+    elif options.resume:
+      console.print('  [highlight] Checking for unsent changes... [/highlight]')
+      result = pt.resume(consumer_key, access_token)
+      console.print(result)
+
+    elif options.daemon:
+      from pocketsnack import daemon
+      console.print(daemon.run(S))
+
+    elif options.control:
+      from pocketsnack import daemon
+      address = (S.get('daemon') or {}).get('control') or daemon.default_control
+      try:
+        reply = daemon.request(address, ' '.join(options.control))
+      except OSError:
+        console.print('  [highlight] There is no pocketsnack daemon listening on ' + address + ' [/highlight] Start one with [command] pocketsnack --daemon [/command]')
+      else:
+        if 'error' in reply:
+          console.print('  [bold red on color(255)] ' + reply['error'] + ' [/bold red on color(255)]')
+        elif 'jobs' in reply:
+          console.print(daemon.status_message(reply))
+        elif 'queued' in reply:
+          console.print('  [command] ' + reply['queued'] + ' [/command] will run as soon as the daemon is free.')
+        else:
+          console.print('  The daemon is stopping.')
+
     elif options.test:
       result = pt.test(consumer_key, access_token)
       console.print(result)
     
-    elif options.version:
-      # version number from package info
-      vnum = pkg_resources.require("pocketsnack")[0].version
-      print(vnum)
-
     elif set(true_vars).intersection(orphans):
       console.print('\n   That command cannot be used by itself. Check [highlight] pocketsnack --help [/highlight] for more information\n')
 
@@ -233,96 +380,69 @@ def main():
     # we do nothing here
     pass
 
+  except pt.retry.PocketUnavailable as e:
+    console.print('  [highlight] Sorry, could not reach Pocket: ' + str(e) + ' [/highlight]')
+
+  except pt.retry.PocketError as e:
+    console.print('  [highlight] Sorry, something went wrong talking to Pocket: ' + str(e) + ' [/highlight]')
+
   except ValueError:
     console.print("  :flushed_face: Whoops, looks like there is a problem with your config file. Try [highlight] pocketsnack --config [/highlight] to fix this")
 
+  finally:
+    # where the time went, even if the command failed part way
+    if options.timings:
+      err_console.print(pt.metrics.summary())
+    metrics_file = options.metrics_file or S.get('metrics_file')
+    if metrics_file:
+      pt.metrics.write(metrics_file, S.get('account_name'))
+
 # -----------------------------------
 # Parse commands (the action is here)
 # -----------------------------------
-try:
-
-  configyaml = open(config_file, 'r')
-  for S in yaml.safe_load_all(configyaml):
-
-    # ----------------
-    # Settings
-    # ----------------
-
-    # assign short variable names from the config file
-    access_token = S['pocket_access_token']
-    consumer_key = S['pocket_consumer_key']
-    archive_tag = S['archive_tag']
-    ignore_tags = set(S['ignore_tags'])
-    retain_tags = set(S['retain_tags'])
-
-    # ----------------
-    # argparser arguments
-    # ----------------
-
-    parser = ArgumentParser(description='pocketsnack: KonMari your Pocket tsundoku from the command line')
-    admin = parser.add_argument_group('admin commands')
-    actions = parser.add_argument_group('action commands')
-    mex = parser.add_mutually_exclusive_group()
-    timers = parser.add_mutually_exclusive_group()
-
-    mex.add_argument(
-        "-a", "--archive", action="store_true", help="get information on TBR items in archive (with -i) or purge tags in archive (with -p)"
-    )
-    mex.add_argument(
-        "-b", "--all", action="store_true", help="purge all tags in both list and archive (with -p) or dedupe both list and archive (with --dedupe)"
-    )
-    actions.add_argument(
-        "-c", "--config", action="store_true", help="create or edit your config file stored at ~/.pocketsnack_conf.yml"
-    )
-    actions.add_argument(
-        "-d", "--lucky_dip", action="store_true", help="move random items tagged 'tbr' from archive to list, depending on config"
-    )
-    actions.add_argument(
-        "--dedupe", action="store_true", help="de-duplicate list (-l), archive (-a), tbr items (--tbr) or all (-b). Defaults to list"
-    )
-    actions.add_argument(
-        "-i", "--info", action="store_true", help="get information on items in list or TBR items in archive"
-    )
-    mex.add_argument(
-        "-l", "--list", action="store_true", help="get information on items in list (with -i) or purge tags in list (with -p)"
-    )
-    timers.add_argument(
-        "-n", "--since", type=int, help="only act on items where last activity is newer than a given number of days. Use with any action command"
-    )
-    timers.add_argument(
-        "-o", "--before", type=int, help="only act on items where last activity is older than a given number of days. Use with any action command"
-    )
-    actions.add_argument(
-        "-p", "--purge", action="store_true", help="remove all tags from list, archive, or both, depending on the second argument provided and excepting tags listed in 'retain_tags' in config"
-    )
-    actions.add_argument(
-        "-s", "--stash", action="store_true", help="add 'tbr' tag to all items in user list and archive them, with exceptions as per config"
-    )
-    admin.add_argument(
-        "-t", "--test", action="store_true", help="test whether API call returns data"
-    )
-    mex.add_argument(
-        "--tbr", action="store_true", help="used in conjuction with --dedupe to dedupe only items in the tbr archive"
-    )
-    admin.add_argument(
-        "-u", "--authorise", action="store_true", help="authorise app to connect to a Pocket account"
-    )
-    admin.add_argument(
-        "-v", "--version", action="store_true", help="print the current version number to screen"
-    )
-
-    options = parser.parse_args()
-    configyaml.close() # we don't need to leave this open: if we do, Windows can't "authorise"
-
-  if __name__ == '__main__':
-
-    main()
-
-except FileNotFoundError:
-  console.print(' [highlight] pocketsnack [/highlight] needs a config file!')
-  user_input = input('  Do you want to create one now using your default text editor (y/n)?')
-  if user_input in ["y", "yes", "Y", "Yes", "YES"]:
-    conf = pt.config(config_file)
-    console.print(conf)
-  else:
-    console.print('  Some other time then.')
+
+def main():
+
+  options = make_parser().parse_args()
+
+  # nothing else to load for these
+  if options.version:
+    print(get_version())
+    return
+
+  import yaml
+  from pocketsnack import toolkit as pt
+  console = pt.console
+
+  try:
+    # we don't leave the file open: if we do, Windows can't "authorise"
+    with open(config_file, 'r') as configyaml:
+      # a stray '---' (say at the end of the file) gives an empty document
+      documents = [S for S in yaml.safe_load_all(configyaml) if S is not None]
+  except FileNotFoundError:
+    console.print(' [highlight] pocketsnack [/highlight] needs a config file!')
+    user_input = input('  Do you want to create one now using your default text editor (y/n)?')
+    if user_input in ["y", "yes", "Y", "Yes", "YES"]:
+      conf = pt.config(config_file)
+      console.print(conf)
+    else:
+      console.print('  Some other time then.')
+    return
+
+  if len(documents) == 0:
+    console.print("  :flushed_face: Whoops, looks like there is a problem with your config file. Try [highlight] pocketsnack --config [/highlight] to fix this")
+    return
+
+  # each document in the config file is an account (see accounts.py)
+  # commands that don't ask questions run for all of them at once
+  if len(documents) > 1:
+    from pocketsnack import accounts
+    if accounts.runs_per_account(options):
+      accounts.run_all(options, documents, console, options.parallel)
+      return
+
+  # everything else uses the last one
+  run(options, documents[-1])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,163 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import random
+import threading
+import time
+
+# contextvars is new in Python 3.7
+try:
+  import contextvars
+except ImportError:
+  contextvars = None
+
+# -----------------------------------------------------------
+# Retrying
+# -----------------------------------------------------------
+# Every call to Pocket goes through one retry loop (see call() in
+# toolkit.py and aio.py). Each failed attempt is sorted into a kind:
+#
+#   connect   - we couldn't reach Pocket, or it stopped answering
+#   server    - Pocket answered with a 5xx error
+#   throttle  - Pocket answered 429 Too Many Requests
+#   limited   - the rate limit scheduler says we've been throttled
+#               (it already knows how long to wait)
+#
+# We wait longer after each failure, with random jitter so that
+# several workers don't all come back at the same moment, and we
+# give up after 'attempts' retries or when the command's deadline
+# would pass before the next try.
+
+class PocketError(Exception):
+  pass
+
+class PocketUnavailable(PocketError):
+  pass
+
+# sort out what went wrong, if anything
+# returns None if the response is fine to hand back to the caller
+def classify(status, limited):
+  if limited:
+    return 'limited'
+  if status == 429:
+    return 'throttle'
+  if status >= 500:
+    return 'server'
+  return None
+
+class RetryPolicy:
+
+  def __init__(self, attempts=4, base_delay=1, max_delay=30):
+    self.attempts = int(attempts)
+    self.base_delay = float(base_delay)
+    self.max_delay = float(max_delay)
+
+  # how long to wait before the next attempt
+  def delay(self, attempt, kind, retry_after=None):
+    if kind == 'limited':
+      return 0 # the scheduler holds everyone back until it's safe
+    if retry_after:
+      try:
+        return min(self.max_delay, float(retry_after))
+      except ValueError:
+        pass
+    # 'full jitter': anywhere between nothing and the exponential backoff
+    return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+# -----------------------------------------------------------
+# Deadlines
+# -----------------------------------------------------------
+# A deadline covers a whole command (stash, dedupe etc) rather than a
+# single request. It is kept in a context variable, so commands running
+# side by side each have their own - including asyncio commands sharing
+# one thread, since every task gets its own copy of the context.
+#
+# Worker threads start with an empty context, so anything handed to a
+# thread pool should be wrapped in keep_deadline() first.
+#
+# Python 3.6 has no context variables, so there the deadline is kept
+# per thread instead, and asyncio commands sharing a thread share it.
+
+class ThreadDeadline:
+
+  def __init__(self):
+    self.local = threading.local()
+
+  def get(self):
+    return getattr(self.local, 'value', None)
+
+  def set(self, value):
+    previous = self.get()
+    self.local.value = value
+    return previous
+
+  def reset(self, previous):
+    self.local.value = previous
+
+deadline = contextvars.ContextVar('deadline', default=None) if contextvars else ThreadDeadline()
+
+def start_deadline(seconds):
+  deadline.set(time.monotonic() + seconds if seconds else None)
+
+def time_left():
+  end = deadline.get()
+  return None if end is None else end - time.monotonic()
+
+# wrap func so it runs with the deadline of the command calling keep_deadline()
+def keep_deadline(func):
+  end = deadline.get()
+
+  def run(*args):
+    token = deadline.set(end)
+    try:
+      return func(*args)
+    finally:
+      deadline.reset(token)
+
+  return run
+
+# should we wait 'delay' seconds and try again?
+def should_retry(policy, attempt, delay):
+  if attempt >= policy.attempts:
+    return False
+  remaining = time_left()
+  return remaining is None or delay < remaining
+
+# the errors we raise instead of handing back a failed response
+# we leave out the original error because its URL can include the access token
+def out_of_time():
+  return PocketUnavailable('the time allowed for this command ran out')
+
+# when should_retry says no
+# 'status' is Pocket's last answer, if it gave one
+def give_up(policy, attempt, status=None):
+  if attempt < policy.attempts:
+    return out_of_time()
+  if status:
+    return PocketUnavailable('Pocket still answered ' + str(status) + ' after ' + str(attempt + 1) + ' attempts')
+  return PocketUnavailable('no connection after ' + str(attempt + 1) + ' attempts')
+
+# when Pocket turns a request down, eg because the access token is wrong
+def refused(status, reason):
+  return PocketError('Pocket answered ' + str(status) + ' ' + str(reason or ''))
@@ -0,0 +1,142 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import heapq
+import math
+import random
+import time
+from urllib.parse import urlsplit
+
+# -----------------------------------------------------------
+# Reservoir sampling
+# -----------------------------------------------------------
+# A reservoir keeps a random sample of up to 'size' entries from a
+# stream of any length, in one pass and without holding the whole
+# stream in memory. 'seen' counts everything offered to it.
+#
+# Entries can be weighted (Efraimidis & Spirakis): each gets the key
+# u ** (1 / weight) for a random u, and the sample is the entries with
+# the largest keys. A min-heap holds the best 'size' keys so far, so a
+# stream of n items costs O(n log size). With every weight at 1 this is
+# an ordinary uniform sample.
+
+class Reservoir:
+
+  def __init__(self, size, rng=random):
+    self.size = size
+    self.rng = rng
+    self.heap = [] # (key, arrival, entry) with the smallest key on top
+    self.seen = 0
+
+  def add(self, entry, weight=1):
+    self.seen += 1
+    # log(u) / weight orders entries the same way as u ** (1 / weight)
+    # without underflowing for small weights. 1 - random() is never 0
+    key = math.log(1.0 - self.rng.random()) / weight
+    if len(self.heap) < self.size:
+      heapq.heappush(self.heap, (key, self.seen, entry))
+    elif key > self.heap[0][0]:
+      heapq.heapreplace(self.heap, (key, self.seen, entry))
+
+  @property
+  def entries(self):
+    return [entry for key, arrival, entry in self.heap]
+
+  # everything in the reservoir whose item id isn't in 'exclude'
+  def available(self, exclude):
+    return [entry for entry in self.entries if entry[0] not in exclude]
+
+  # the n entries with the best keys, leaving out anything in 'exclude'
+  def sample(self, n, exclude):
+    pool = [row for row in self.heap if row[2][0] not in exclude]
+    return [entry for key, arrival, entry in heapq.nlargest(n, pool)]
+
+# -----------------------------------------------------------
+# Scoring
+# -----------------------------------------------------------
+# make_scorer() turns the 'lucky_dip_weights' setting into a function
+# giving each item a weight. Every item starts at 1, and gets extra
+# weight for its age, its length, its tags and its domain:
+#
+#   lucky_dip_weights:
+#     age: 0.5          # per year since it was added
+#     word_count: 0.2   # per 1000 words
+#     tags:
+#       python: 2
+#     domains:
+#       longreads.com: 1
+#
+# 'weights' can also be a function taking an Item (see items.py).
+# Negative values make items less likely to be picked, but nothing
+# drops below min_weight so that every item still has a chance.
+
+min_weight = 0.01
+seconds_per_year = 365.25 * 24 * 60 * 60
+
+def item_domain(item):
+  host = urlsplit(item.url).hostname or ''
+  return host[len('www.'):] if host.startswith('www.') else host
+
+# the item fields a scorer made from these weights looks at (see items.py)
+# None means all of them, since we can't see inside a function
+def scorer_fields(weights):
+  if not weights:
+    return set()
+  if callable(weights):
+    return None
+  fields = set()
+  if weights.get('age'):
+    fields.add('time_added')
+  if weights.get('word_count'):
+    fields.add('word_count')
+  if weights.get('tags'):
+    fields.add('tags')
+  if weights.get('domains'):
+    fields.update(('given_url', 'resolved_url'))
+  return fields
+
+def make_scorer(weights, now=None):
+  if not weights:
+    return None
+  if callable(weights):
+    return lambda item: max(min_weight, weights(item))
+  now = now or time.time()
+  age = float(weights.get('age') or 0)
+  word_count = float(weights.get('word_count') or 0)
+  tags = weights.get('tags') or {}
+  domains = weights.get('domains') or {}
+
+  def score(item):
+    weight = 1.0
+    if age:
+      weight += age * max(0, now - (item.time_added or now)) / seconds_per_year
+    if word_count:
+      weight += word_count * item.word_count / 1000
+    for tag in item.tags:
+      weight += tags.get(tag, 0)
+    if domains:
+      weight += domains.get(item_domain(item), 0)
+    return max(min_weight, weight)
+
+  return score
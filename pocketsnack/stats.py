@@ -0,0 +1,177 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from bisect import bisect_right
+import json
+import time
+
+# local modules
+from pocketsnack import sampling
+
+# -----------------------------------------------------------
+# Top k
+# -----------------------------------------------------------
+# Counting every domain or tag in a huge account would need one
+# counter per distinct value. The Space-Saving algorithm keeps at most
+# 'size' counters: when a new value turns up and they're all taken, it
+# replaces the smallest one and carries its count over. Anything seen
+# more than n / size times is guaranteed a counter, and 'error' is how
+# far each count might be over the true number.
+
+class SpaceSaving:
+
+  def __init__(self, size):
+    self.size = size
+    self.counts = {} # value -> [count, error]
+
+  def add(self, value):
+    counter = self.counts.get(value)
+    if counter:
+      counter[0] += 1
+    elif len(self.counts) < self.size:
+      self.counts[value] = [1, 0]
+    else:
+      smallest = min(self.counts, key=lambda v: self.counts[v][0])
+      count = self.counts.pop(smallest)[0]
+      self.counts[value] = [count + 1, count]
+
+  # the k most frequent values as (value, count, error), most frequent first
+  def top(self, k):
+    ranked = sorted(self.counts.items(), key=lambda pair: (-pair[1][0], pair[0]))
+    return [(value, count, error) for value, (count, error) in ranked[:k]]
+
+# -----------------------------------------------------------
+# Histograms
+# -----------------------------------------------------------
+# A fixed set of buckets, each counting values from its lower edge up
+# to (but not including) the next one. The last bucket has no upper edge.
+
+class Histogram:
+
+  def __init__(self, edges, labels):
+    self.edges = edges
+    self.labels = labels
+    self.counts = [0] * len(edges)
+
+  def add(self, value):
+    self.counts[max(0, bisect_right(self.edges, value) - 1)] += 1
+
+  def buckets(self):
+    return dict(zip(self.labels, self.counts))
+
+word_count_edges = [0, 1, 500, 1000, 2000, 3000, 5000, 10000]
+word_count_labels = ['none', '1-499', '500-999', '1000-1999', '2000-2999', '3000-4999', '5000-9999', '10000+']
+
+day = 24 * 60 * 60
+age_edges = [0, 7 * day, 30 * day, 90 * day, 365 * day, 2 * 365 * day]
+age_labels = ['under a week', 'under a month', 'under 3 months', 'under a year', 'under 2 years', '2 years or more']
+
+# -----------------------------------------------------------
+# Item statistics
+# -----------------------------------------------------------
+# Gathered one item at a time as they stream in from Pocket or the
+# local store. Memory use doesn't depend on how many items there are:
+# everything is a counter, a fixed histogram, or a Space-Saving top k.
+
+class ItemStats:
+
+  def __init__(self, longreads_wordcount, top=10, now=None):
+    self.longreads_wordcount = longreads_wordcount
+    self.top = top
+    self.now = now or time.time()
+    self.items = 0
+    self.longreads = 0
+    self.videos = 0
+    self.images = 0
+    self.favorites = 0
+    self.word_counts = Histogram(word_count_edges, word_count_labels)
+    self.ages = Histogram(age_edges, age_labels)
+    # keep a few spare counters so the top entries are reliable
+    self.domains = SpaceSaving(top * 10)
+    self.tags = SpaceSaving(top * 10)
+
+  def add(self, item):
+    self.items += 1
+    self.word_counts.add(item.word_count)
+    if item.word_count > self.longreads_wordcount:
+      self.longreads += 1
+    if item.has_video == 2:
+      self.videos += 1
+    if item.has_image == 2:
+      self.images += 1
+    if item.favorite:
+      self.favorites += 1
+    if item.time_added:
+      self.ages.add(self.now - item.time_added)
+    domain = sampling.item_domain(item)
+    if domain:
+      self.domains.add(domain)
+    for tag in item.tags:
+      self.tags.add(tag)
+
+  def summary(self):
+    return {
+      'items': self.items,
+      'longreads': self.longreads,
+      'videos': self.videos,
+      'images': self.images,
+      'favorites': self.favorites,
+      'word_count': self.word_counts.buckets(),
+      'age': self.ages.buckets(),
+      'domains': [{'domain': value, 'count': count, 'error': error} for value, count, error in self.domains.top(self.top)],
+      'tags': [{'tag': value, 'count': count, 'error': error} for value, count, error in self.tags.top(self.top)],
+    }
+
+# -----------------------------------------------------------
+# Output
+# -----------------------------------------------------------
+# JSON is the summary as one document. NDJSON is one line per figure,
+# which is easier to load into a dashboard:
+#   {"metric": "items", "value": 1234}
+#   {"metric": "age", "bucket": "under a week", "value": 12}
+#   {"metric": "domains", "domain": "example.com", "value": 40, "error": 0}
+
+def as_json(summary):
+  return json.dumps(summary, indent=2)
+
+def ndjson_rows(summary):
+  for metric, value in summary.items():
+    if isinstance(value, dict):
+      for bucket, count in value.items():
+        yield {'metric': metric, 'bucket': bucket, 'value': count}
+    elif isinstance(value, list):
+      for entry in value:
+        row = {'metric': metric}
+        row.update(entry)
+        row['value'] = row.pop('count')
+        yield row
+    else:
+      yield {'metric': metric, 'value': value}
+
+# with 'account', every row says which account it's for
+def as_ndjson(summary, account=None):
+  rows = ndjson_rows(summary)
+  if account:
+    rows = (dict({'account': account}, **row) for row in rows)
+  return '\n'.join(json.dumps(row) for row in rows)
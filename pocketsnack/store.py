@@ -0,0 +1,239 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+import hashlib
+import json
+import sqlite3
+
+# local modules
+from pocketsnack.items import Item, as_int
+
+# -----------------------------------------------------------
+# Local item store
+# -----------------------------------------------------------
+# A SQLite mirror of a Pocket account.
+# The store remembers the 'since' value Pocket returns with every
+# call to /v3/get, so each sync only needs to ask for the items
+# that have changed since the last one. Items Pocket reports with
+# status '2' have been deleted, so we drop them from the mirror.
+# Reads then work locally, with the same filters as the API.
+
+schema = """
+CREATE TABLE IF NOT EXISTS items (
+  account TEXT NOT NULL,
+  item_id TEXT NOT NULL,
+  status TEXT,
+  favorite TEXT,
+  time_added INTEGER,
+  time_updated INTEGER,
+  data TEXT,
+  PRIMARY KEY (account, item_id)
+);
+CREATE TABLE IF NOT EXISTS tags (
+  account TEXT NOT NULL,
+  item_id TEXT NOT NULL,
+  tag TEXT NOT NULL,
+  PRIMARY KEY (account, item_id, tag)
+);
+CREATE TABLE IF NOT EXISTS sync (
+  account TEXT PRIMARY KEY,
+  since INTEGER
+);
+CREATE TABLE IF NOT EXISTS url_keys (
+  account TEXT NOT NULL,
+  item_id TEXT NOT NULL,
+  url_key BLOB NOT NULL,
+  PRIMARY KEY (account, item_id)
+);
+CREATE TABLE IF NOT EXISTS url_rules (
+  account TEXT PRIMARY KEY,
+  rules TEXT
+);
+CREATE TABLE IF NOT EXISTS dedupe_runs (
+  account TEXT NOT NULL,
+  scope TEXT NOT NULL,
+  since INTEGER,
+  PRIMARY KEY (account, scope)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (account, status, time_updated);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (account, tag);
+CREATE INDEX IF NOT EXISTS url_keys_key ON url_keys (account, url_key);
+"""
+
+# several accounts can share one file, so wait a while if another is writing
+def connect(path):
+  conn = sqlite3.connect(path, timeout=60)
+  conn.executescript(schema)
+  return conn
+
+# rows are scoped to an account so one file can hold several Pocket accounts
+# we never want the token itself sitting in the database, so use a digest
+def account_key(pocket_access_token):
+  return hashlib.sha1(pocket_access_token.encode('utf-8')).hexdigest()
+
+def get_since(conn, account):
+  row = conn.execute('SELECT since FROM sync WHERE account = ?', (account,)).fetchone()
+  return row[0] if row else None
+
+def set_since(conn, account, since):
+  conn.execute('INSERT OR REPLACE INTO sync (account, since) VALUES (?, ?)', (account, since))
+
+# apply (item_id, data) pairs from a /v3/get 'list' to the mirror
+# returns the number of rows changed and the number removed
+def apply_items(conn, account, items):
+  changed = 0
+  removed = 0
+  for item_id, data in items:
+    item = Item.from_json(item_id, data)
+    conn.execute('DELETE FROM tags WHERE account = ? AND item_id = ?', (account, item_id))
+    # the url may have changed too, so the dedupe index needs a fresh key
+    conn.execute('DELETE FROM url_keys WHERE account = ? AND item_id = ?', (account, item_id))
+    if item.status == 2:
+      # tombstone - the item has been deleted in Pocket
+      conn.execute('DELETE FROM items WHERE account = ? AND item_id = ?', (account, item_id))
+      removed += 1
+      continue
+    # only the compact fields are kept (see items.py)
+    conn.execute(
+      'INSERT OR REPLACE INTO items (account, item_id, status, favorite, time_added, time_updated, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (account, item_id, str(item.status), str(item.favorite), item.time_added, item.time_updated, json.dumps(item.to_json()))
+      )
+    if item.tags:
+      conn.executemany(
+        'INSERT OR IGNORE INTO tags (account, item_id, tag) VALUES (?, ?, ?)',
+        [(account, item_id, tag) for tag in item.tags]
+        )
+    changed += 1
+  return changed, removed
+
+# build the WHERE clause for the same params we would send to /v3/get
+# 'state', 'tag', 'favorite' and 'since' are honoured
+def where_clause(account, params):
+  sql = 'account = ?'
+  args = [account]
+
+  state = params.get('state', 'unread')
+  if state == 'unread':
+    sql += " AND status = '0'"
+  elif state == 'archive':
+    sql += " AND status = '1'"
+
+  if 'favorite' in params:
+    sql += ' AND favorite = ?'
+    args.append(str(params['favorite']))
+
+  if 'since' in params:
+    sql += ' AND time_updated >= ?'
+    args.append(as_int(params['since']))
+
+  tag = params.get('tag')
+  if tag == '_untagged_':
+    sql += ' AND item_id NOT IN (SELECT item_id FROM tags WHERE account = ?)'
+    args.append(account)
+  elif tag:
+    sql += ' AND item_id IN (SELECT item_id FROM tags WHERE account = ? AND tag = ?)'
+    args.extend([account, tag])
+
+  return sql, args
+
+def count_items(conn, account):
+  return conn.execute('SELECT COUNT(*) FROM items WHERE account = ?', (account,)).fetchone()[0]
+
+# read items from the mirror using the same params we would send to /v3/get
+# results are yielded newest first, just like Pocket's default sort
+# 'fields' limits which Item fields are filled in (see items.py)
+def query(conn, account, params, fields=None):
+  where, args = where_clause(account, params)
+  sql = 'SELECT item_id, data FROM items WHERE ' + where + ' ORDER BY time_added DESC, item_id DESC'
+  for item_id, data in conn.execute(sql, args):
+    yield item_id, Item.from_json(item_id, json.loads(data), fields)
+
+# -----------------------------------------------------------
+# Dedupe index
+# -----------------------------------------------------------
+# Alongside the mirror we keep a hashed key of each item's canonical
+# URL (see urls.py). Keys are made by the caller, because they depend
+# on the dedupe rules in the config file. If the rules change, the keys
+# are thrown away and made again.
+# Each dedupe scope (list, archive, tbr etc) remembers when it last ran,
+# so the next run only needs to look at items changed since then.
+
+def get_url_rules(conn, account):
+  row = conn.execute('SELECT rules FROM url_rules WHERE account = ?', (account,)).fetchone()
+  return row[0] if row else None
+
+# start the index again with a new set of rules
+def reset_url_keys(conn, account, rules):
+  conn.execute('DELETE FROM url_keys WHERE account = ?', (account,))
+  conn.execute('DELETE FROM dedupe_runs WHERE account = ?', (account,))
+  conn.execute('INSERT OR REPLACE INTO url_rules (account, rules) VALUES (?, ?)', (account, rules))
+
+# items that don't have a key yet
+def missing_url_keys(conn, account):
+  sql = 'SELECT item_id, data FROM items WHERE account = ? AND item_id NOT IN (SELECT item_id FROM url_keys WHERE account = ?)'
+  for item_id, data in conn.execute(sql, (account, account)).fetchall():
+    yield item_id, Item.from_json(item_id, json.loads(data))
+
+def set_url_keys(conn, account, keys):
+  conn.executemany(
+    'INSERT OR REPLACE INTO url_keys (account, item_id, url_key) VALUES (?, ?, ?)',
+    [(account, item_id, key) for item_id, key in keys]
+    )
+
+def get_dedupe_since(conn, account, scope):
+  row = conn.execute('SELECT since FROM dedupe_runs WHERE account = ? AND scope = ?', (account, scope)).fetchone()
+  return row[0] if row else None
+
+def set_dedupe_since(conn, account, scope, since):
+  conn.execute('INSERT OR REPLACE INTO dedupe_runs (account, scope, since) VALUES (?, ?, ?)', (account, scope, since))
+
+# find every group of items in scope that share a url key
+# if 'since' is given, only groups including an item changed since then are returned
+# returns how many items were checked, and a list of groups of (item_id, item), newest first
+def duplicate_groups(conn, account, params, since=None):
+  where, args = where_clause(account, params)
+  scope = 'SELECT item_id FROM items WHERE ' + where
+
+  if since:
+    checked_sql = 'SELECT COUNT(*) FROM items WHERE ' + where + ' AND time_updated >= ?'
+    checked_args = args + [since]
+    candidates = 'SELECT url_key FROM url_keys WHERE account = ? AND item_id IN (' + scope + ' AND time_updated >= ?)'
+    candidate_args = [account] + args + [since]
+  else:
+    checked_sql = 'SELECT COUNT(*) FROM items WHERE ' + where
+    checked_args = args
+    candidates = 'SELECT url_key FROM url_keys WHERE account = ? AND item_id IN (' + scope + ') GROUP BY url_key HAVING COUNT(*) > 1'
+    candidate_args = [account] + args
+
+  checked = conn.execute(checked_sql, checked_args).fetchone()[0]
+
+  sql = (
+    'SELECT k.url_key, i.item_id, i.data FROM url_keys k JOIN items i ON i.account = k.account AND i.item_id = k.item_id'
+    ' WHERE k.account = ? AND k.item_id IN (' + scope + ') AND k.url_key IN (' + candidates + ')'
+    ' ORDER BY i.time_added DESC, i.item_id DESC'
+    )
+  groups = {}
+  for key, item_id, data in conn.execute(sql, [account] + args + candidate_args):
+    groups.setdefault(key, []).append((item_id, Item.from_json(item_id, json.loads(data))))
+  return checked, [group for group in groups.values() if len(group) > 1]
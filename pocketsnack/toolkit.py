@@ -21,7 +21,6 @@
 # Import libraries
 # ----------------
 
-import requests
 from rich.console import Console
 from rich.theme import Theme
 
@@ -32,13 +31,24 @@ import json
 import os
 import random
 import re
-import socket
 import subprocess
 import sys
 import time
-import urllib
 import webbrowser
 
+# local modules
+from pocketsnack import dispatch
+from pocketsnack import journal
+from pocketsnack import jsonstream
+from pocketsnack import metrics
+from pocketsnack import plan
+from pocketsnack import retry
+from pocketsnack import sampling
+from pocketsnack import stats
+from pocketsnack import store
+from pocketsnack import urls
+from pocketsnack.items import Item, detail_type
+
 # set up rich
 custom_theme = Theme({
     "highlight" : "color(255) on cyan",
@@ -61,23 +71,109 @@ console = Console(theme=custom_theme, highlight=False)
 
 # Pocket expects particular HTTP headers to send and receive JSON
 headers = {"Content-Type": "application/json; charset=UTF-8", "X-Accept": "application/json"}
+# pages of items are mostly repeated field names, so they compress very well
+get_headers = {**headers, "Accept-Encoding": "gzip"}
+
+# where to find the Pocket API
+api_url = 'https://getpocket.com/v3'
+
+# HTTP connection pool settings
+# every call goes through one shared session, so each connection is
+# opened once and then kept alive for the rest of the command
+pool_size = 10
+timeout = (10, 60) # seconds to connect, seconds to wait for a response
+http_session = None
+
+# requests is only imported when we first need it, which keeps
+# commands that never call Pocket (like --config) quick to start
+def session():
+  global http_session
+  if http_session is None:
+    import requests
+    http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+  return http_session
+
+def configure_http(size, connect_timeout, read_timeout):
+  global pool_size, timeout, http_session
+  pool_size = int(size)
+  timeout = (connect_timeout, read_timeout)
+  # start again with the new settings next time we need a connection
+  if http_session is not None:
+    http_session.close()
+    http_session = None
+
+# every call is paced by the rate limit headers Pocket sends back
+scheduler = dispatch.RateLimitScheduler()
+# and retried with backoff when something goes wrong (see retry.py)
+retry_policy = retry.RetryPolicy()
+# seconds allowed for each command, or None for no limit
+command_deadline = None
+
+def set_rate_limits(reserve):
+  global scheduler
+  scheduler = dispatch.RateLimitScheduler(reserve)
+
+def set_retries(attempts, base_delay, max_delay, deadline):
+  global retry_policy, command_deadline
+  retry_policy = retry.RetryPolicy(attempts, base_delay, max_delay)
+  command_deadline = deadline
+
+# start the clock for a command
+def start_command():
+  retry.start_deadline(command_deadline)
+
+# POST to the API, waiting our turn and retrying if something goes wrong
+# returns the response, or raises retry.PocketUnavailable if we can't reach Pocket
+# before we run out of retries or the command runs out of time
+# the time spent waiting, calling and backing off is recorded in metrics.py
+def call(endpoint, **kwargs):
+  import requests
+  attempt = 0
+  while True:
+    with metrics.timer('rate limit wait'):
+      if not scheduler.wait(retry.time_left()):
+        raise retry.out_of_time()
+    try:
+      with metrics.timer('http ' + endpoint):
+        response = session().post(api_url + endpoint, timeout=timeout, **kwargs)
+      metrics.count('requests ' + endpoint)
+      metrics.count('bytes sent', len(response.request.url) + len(response.request.body or b''))
+      # a streamed response without a length is counted as it's read (see page_items)
+      if 'Content-Length' in response.headers or not kwargs.get('stream'):
+        metrics.count('bytes received', int(response.headers.get('Content-Length') or len(response.content)))
+    except (requests.ConnectionError, requests.Timeout):
+      delay = retry_policy.delay(attempt, 'connect')
+      if not retry.should_retry(retry_policy, attempt, delay):
+        raise retry.give_up(retry_policy, attempt)
+    else:
+      scheduler.update(response.status_code, response.headers)
+      kind = retry.classify(response.status_code, scheduler.throttled(response.status_code, response.headers))
+      if kind is None:
+        return response
+      delay = retry_policy.delay(attempt, kind, response.headers.get('Retry-After'))
+      # give the connection back to the pool before we try again
+      response.close()
+      if not retry.should_retry(retry_policy, attempt, delay):
+        raise retry.give_up(retry_policy, attempt, response.status_code)
+    attempt += 1
+    metrics.count('retries')
+    with metrics.timer('retry backoff'):
+      time.sleep(delay)
 
 # send GET requests
-def get(params):
-  return requests.post('https://getpocket.com/v3/get', headers=headers, params=params)
+# with stream=True the body is left to be read as it arrives
+def get(params, stream=False):
+  return call('/get', headers=get_headers, params=params, stream=stream)
 
 # send POST requests
-def send(actions_escaped, consumer_key, pocket_access_token):
+def send(actions, consumer_key, pocket_access_token):
   # POST changes to tags
-  return requests.post('https://getpocket.com/v3/send?actions=' + actions_escaped + '&access_token=' + pocket_access_token + '&consumer_key=' + consumer_key)
-# check the internet connection is live
-def connection_live():
-  try:
-    socket.create_connection(("getpocket.com", 443), 10)
-    return True
-  except OSError:
-      pass
-  return False
+  # the actions go in the JSON body, so there's no URL length to worry about
+  body = {"consumer_key": consumer_key, "access_token": pocket_access_token, "actions": actions}
+  return call('/send', headers=headers, data=json.dumps(body))
 
 # make a unix timestamp for before/after flags with Pocket's 'since' param
 def get_timestamp(since):
@@ -87,48 +183,385 @@ def get_timestamp(since):
   strptime = time.strptime(since_time)
   return time.mktime(strptime) # return Unix timestamp
 
-def get_item_list(params, before, since):
+# make unix timestamps for the --between flag
+# START and END are dates like 2021-03-31, and END is included in the window
+def get_window(between):
+  start, end = between
+  start_time = datetime.strptime(start, '%Y-%m-%d')
+  end_time = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)
+  return time.mktime(start_time.timetuple()), time.mktime(end_time.timetuple())
+
+# turn before/since/between into the earliest and latest time_updated to keep
+# either can be None, which means there's no limit at that end
+def time_window(before, since, between):
+  earliest = None
+  latest = None
+  if between:
+    earliest, latest = get_window(between)
+  if since:
+    earliest = get_timestamp(since)
   if before:
-    all_items = get(params)
-    params['since'] = get_timestamp(before)
-    since_items = get(params)
-    # get non-intersection of 2 groups to get only items last changed 'before'
-    item_list = all_items.json()['list'] # everything
-    since_list = since_items.json()['list'] # only things since 'before'
-    if len(since_list) > 0:
-      for key in since_list.keys():
-        item_list.pop(key, None) # remove everything from items_list that is in since_list
-    return item_list
-  elif since:
-    timestamp = get_timestamp(since)
-    params['since'] = timestamp
-    return get(params).json()['list']
-  else:
-    return get(params).json()['list']
+    latest = get_timestamp(before)
+  return earliest, latest
+
+# Pocket can only filter on the earliest time (with 'since')
+# so we check the latest time ourselves as the items arrive
+# with 'since', Pocket also sends items deleted since then (status 2), which we drop
+def updated_before(items, latest):
+  for item_id, item in items:
+    if item.status == 2:
+      continue
+    if latest is None or item.time_updated < latest:
+      yield item_id, item
+
+# ----------------
+# Local item store
+# ----------------
+
+# path to a SQLite mirror of the account, or None to always ask Pocket
+local_store = None
+
+def use_store(path):
+  global local_store
+  local_store = path
+
+# bring the local mirror up to date
+# only items changed since the last sync are downloaded
+def sync_store(consumer_key, pocket_access_token):
+  conn = store.connect(local_store)
+  account = store.account_key(pocket_access_token)
+  params = {"consumer_key": consumer_key, "access_token": pocket_access_token, "state": "all", "detailType": "complete"}
+  watermark = store.get_since(conn, account)
+  if watermark:
+    params['since'] = watermark
+  since = None
+  for page in get_pages(params):
+    # commit each page as it arrives, so other accounts sharing the store
+    # (see accounts.py) never wait long for it
+    # if we stop part way the watermark hasn't moved, so the next sync starts again
+    with metrics.timer('update store'), conn:
+      store.apply_items(conn, account, page['list'])
+    # use the 'since' from the first page so nothing changed mid-sync is missed next time
+    # it comes after the list, so it's only there once the page has been read
+    since = since or page['since']
+  if since:
+    with conn:
+      store.set_since(conn, account, since)
+  return conn, account
+
+# serve items from the local mirror
+# params should already include any 'since' value
+def iter_store(params, fields=None):
+  conn, account = sync_store(params['consumer_key'], params['access_token'])
+  try:
+    yield from store.query(conn, account, params, fields)
+  finally:
+    conn.close()
+
+# ----------------
+# Retrieving items
+# ----------------
+
+# how many items to ask Pocket for in each call to /v3/get
+page_size = 500
+
+def set_page_size(size):
+  global page_size
+  page_size = int(size)
+
+# apply the optional tuning settings from a config file document
+def configure(settings):
+  global api_url
+  if settings.get('local_store'):
+    use_store(os.path.expanduser(settings['local_store']))
+  if settings.get('page_size'):
+    set_page_size(settings['page_size'])
+  if settings.get('api_url'):
+    api_url = settings['api_url'].rstrip('/')
+  configure_http(
+    settings.get('pool_size') or pool_size,
+    settings.get('connect_timeout') or timeout[0],
+    settings.get('read_timeout') or timeout[1]
+    )
+  set_batch_limits(
+    settings.get('max_batch_size') or max_batch_size,
+    settings.get('max_batch_bytes') or max_batch_bytes
+    )
+  set_send_rate(
+    settings.get('send_workers') or send_workers,
+    settings.get('send_rate') or send_bucket.rate,
+    settings.get('send_burst') or send_bucket.burst
+    )
+  set_rate_limits(settings.get('rate_limit_reserve', scheduler.reserve))
+  set_retries(
+    settings.get('retry_attempts', retry_policy.attempts),
+    settings.get('retry_base_delay', retry_policy.base_delay),
+    settings.get('retry_max_delay', retry_policy.max_delay),
+    settings.get('command_deadline', command_deadline)
+    )
+  set_lucky_dip(settings.get('lucky_dip_weights'), settings.get('lucky_dip_seed'))
+  if 'journal' in settings:
+    use_journal(settings['journal'])
+
+# bytes to read from the network at a time
+download_chunk = 65536
+
+# yield each page of results from /v3/get using count and offset
+# page['list'] yields (item_id, data) pairs as they are decoded (see jsonstream.py)
+# or (item_id, convert(item_id, data)) if convert is given
+# the page's other fields, like 'since', are only there once the list has been read
+def get_pages(params, convert=None):
+  params = dict(params)
+  # a fixed sort order keeps the offsets stable from one page to the next
+  params.setdefault('sort', 'newest')
+  params['count'] = page_size
+  offset = 0
+  while True:
+    params['offset'] = offset
+    page = {'received': 0}
+    page['list'] = page_items(dict(params), page, convert)
+    yield page
+    # finish the page if the caller didn't, so we know how many there were
+    for item in page['list']:
+      pass
+    metrics.count('items retrieved', page['received'])
+    if page['received'] < page_size:
+      break
+    offset += page_size
+
+# decode a page of items as it downloads
+# if the connection drops part way, ask for the page again and skip
+# the items we've already handed over
+def page_items(params, page, convert=None):
+  import requests
+  attempt = 0
+  while True:
+    skip = page['received']
+    response = get(params, stream=True)
+    try:
+      # not raise_for_status(), which would put the access token in the error
+      if not response.ok:
+        raise retry.refused(response.status_code, response.headers.get('X-Error') or response.reason)
+      for item_id, data in jsonstream.iter_members(response.iter_content(download_chunk), 'list', page, convert):
+        if skip:
+          skip -= 1
+          continue
+        page['received'] += 1
+        yield item_id, data
+      if 'Content-Length' not in response.headers:
+        metrics.count('bytes received', response.raw.tell())
+      return
+    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+      delay = retry_policy.delay(attempt, 'connect')
+      if not retry.should_retry(retry_policy, attempt, delay):
+        raise retry.give_up(retry_policy, attempt)
+    finally:
+      response.close()
+    attempt += 1
+    metrics.count('retries')
+    with metrics.timer('retry backoff'):
+      time.sleep(delay)
+
+# yield (item_id, Item) pairs as they arrive
+# each item becomes an Item as soon as it's decoded, keeping only 'fields'
+def iter_items(params, fields=None):
+  for page in get_pages(params, lambda item_id, data: Item.from_json(item_id, data, fields)):
+    yield from page['list']
+
+# stream the items matching params, honouring the before/since/between filters
+# this is a single retrieval: items last changed too recently are dropped as they arrive
+# 'fields' is the set of Item fields the caller will read (see items.py)
+# we ask for the lightest detailType that has them, and the rest are left out
+def iter_item_list(params, before, since, between=None, fields=None):
+  earliest, latest = time_window(before, since, between)
+  if earliest:
+    params['since'] = earliest
+  if fields is not None:
+    # updated_before needs to know when each item was updated, and
+    # whether it was deleted if Pocket is sending changes since a time
+    fields = set(fields) | {'time_updated'}
+    if earliest:
+      fields.add('status')
+    params['detailType'] = detail_type(fields)
+  items = iter_store(params, fields) if local_store else iter_items(params, fields)
+  yield from updated_before(items, latest)
+
+def get_item_list(params, before, since, between=None, fields=None):
+  with metrics.timer('get item list'):
+    return dict(iter_item_list(params, before, since, between, fields))
 
 # --------------------
 # process tag updates
 # --------------------
 
-def process_items(actions, consumer_key, pocket_access_token):
-  # Update the tags
-  # group into smaller chunks of 20 to avoid a 414 (URL too long) error
-  tag_chunks = [actions[i:i+20] for i in range(0, len(actions), 20)]
-
-  # process each chunk
-  for i, chunk in enumerate(tag_chunks):
-
-    actions_string = json.dumps(chunk)
-    # now URL encode it using urllib
-    actions_escaped = urllib.parse.quote(actions_string)
-    print('   Processing ' + str(i*20) + ' to ' + str((i*20)+len(tag_chunks[i])) + ' of ' + str(len(actions)) + '...', end="", flush=True) # printing like this means the return callback is appended to the line
-    # post update to tags
-    update = send(actions_escaped, consumer_key, pocket_access_token)
-    if update.raise_for_status() == None:
-      console.print('[color(255) on green] Ok [/color(255) on green]') # Print 'Ok' in green.
+# the most actions we will put in a single call to /v3/send
+max_batch_size = 250
+# and the most bytes of JSON we will send in one go
+max_batch_bytes = 65536
+
+def set_batch_limits(size, size_bytes):
+  global max_batch_size, max_batch_bytes
+  max_batch_size = int(size)
+  max_batch_bytes = int(size_bytes)
+
+# group actions into batches by the size of their encoded JSON
+# rather than a fixed count, so short actions get packed in tightly
+def pack_actions(actions):
+  batch = []
+  batch_bytes = 2 # the enclosing []
+  for action in actions:
+    action_bytes = len(json.dumps(action)) + 2 # allow for the ', ' separator
+    if batch and (len(batch) >= max_batch_size or batch_bytes + action_bytes > max_batch_bytes):
+      yield batch
+      batch = []
+      batch_bytes = 2
+    batch.append(action)
+    batch_bytes += action_bytes
+  if batch:
+    yield batch
+
+# batches are sent by a small pool of workers
+# a token bucket keeps us to a steady rate of requests per second
+send_workers = 4
+send_bucket = dispatch.TokenBucket(0.5, 5)
+
+def set_send_rate(workers, rate, burst):
+  global send_workers, send_bucket
+  send_workers = int(workers)
+  send_bucket = dispatch.TokenBucket(rate, burst)
+
+# send actions in batches, yielding (batch, response, error) in order
+def send_batches(actions, consumer_key, pocket_access_token):
+  return dispatch.dispatch(
+    pack_actions(actions),
+    retry.keep_deadline(lambda batch: send(batch, consumer_key, pocket_access_token)),
+    send_workers,
+    send_bucket
+    )
+
+# every batch is written to a journal before it is sent, so an
+# interrupted command can be finished with --resume (see journal.py)
+# None means don't keep a journal
+journal_path = os.path.join(os.path.expanduser('~'), '.pocketsnack_journal.db')
+
+def use_journal(path):
+  global journal_path
+  journal_path = os.path.expanduser(path) if path else None
+
+# with dry_run set, commands report what they would send instead of sending it
+dry_run = False
+
+def set_dry_run(flag):
+  global dry_run
+  dry_run = bool(flag)
+
+# the --dry-run report for a plan.Planner and the lists of actions it kept
+def dry_run_report(planner, *action_lists):
+  batches = sum(len(list(pack_actions(actions))) for actions in action_lists)
+  return planner.report(batches)
+
+# send planned (seq, batch) entries, printing progress as each batch comes back
+# batches Pocket accepts or refuses are marked done in the journal, and only
+# those that couldn't be sent (no connection, 5xx, rate limits) stay pending
+# returns how many batches failed and how many Pocket refused
+def send_planned(planned, consumer_key, pocket_access_token, conn=None, run_id=None):
+  total = sum(len(batch) for seq, batch in planned)
+  done = 0
+  failed = 0
+  refused = 0
+  results = dispatch.dispatch(
+    planned,
+    retry.keep_deadline(lambda entry: send(entry[1], consumer_key, pocket_access_token)),
+    send_workers,
+    send_bucket
+    )
+  # process each batch
+  with metrics.timer('process items'):
+    for (seq, batch), update, error in results:
+
+      print('   Processing ' + str(done) + ' to ' + str(done + len(batch)) + ' of ' + str(total) + '...', end="", flush=True) # printing like this means the return callback is appended to the line
+      done += len(batch)
+      if error is None and update.ok:
+        metrics.count('actions sent', len(batch))
+        if conn is not None:
+          journal.mark_done(conn, run_id, seq)
+        console.print('[color(255) on green] Ok [/color(255) on green]') # Print 'Ok' in green.
+      elif error is None:
+        # Pocket answered but said no (call() has already retried 5xx and
+        # rate limits), so sending the batch again won't help
+        refused += 1
+        metrics.count('batches refused')
+        if conn is not None:
+          journal.mark_done(conn, run_id, seq)
+        console.print('  :worried_face: [bold red on color(255)] Pocket refused these changes (' + str(update.status_code) + ' ' + str(update.reason or '') + '). [/bold red on color(255)]')
+      else:
+        failed += 1
+        metrics.count('batches failed')
+        console.print('  :worried_face: [bold red on color(255)] Oh dear, something went wrong. [/bold red on color(255)]') # Print error in red
+  return failed, refused
+
+# send a list of actions in batches
+# every batch is written to the journal before the first one goes out
+# returns how many batches failed (and are left for --resume) and how
+# many Pocket refused
+def process_items(actions, consumer_key, pocket_access_token, command=None):
+  batches = list(pack_actions(actions))
+  if journal_path is None:
+    return send_planned(list(enumerate(batches)), consumer_key, pocket_access_token)
+  conn = journal.connect(journal_path)
+  try:
+    account = store.account_key(pocket_access_token)
+    if journal.unfinished_runs(conn, account):
+      console.print('  There are changes from an earlier run that were never sent. Run [highlight] pocketsnack --resume [/highlight] to send them.')
+    run_id, planned = journal.start_run(conn, account, command, batches)
+    failed, refused = send_planned(planned, consumer_key, pocket_access_token, conn, run_id)
+    journal.finish_run(conn, run_id)
+  finally:
+    conn.close()
+  return failed, refused
+
+# what to say instead of the usual message when some batches weren't sent
+def failed_message(failed, refused=0):
+  lines = []
+  if refused:
+    lines.append('  [bold red on color(255)] Pocket refused ' + str(refused) + ' batches. [/bold red on color(255)] Those changes will not be sent again.')
+  if failed:
+    message = '  [bold red on color(255)] ' + str(failed) + ' batches could not be sent. [/bold red on color(255)] '
+    if journal_path:
+      lines.append(message + 'Run [highlight] pocketsnack --resume [/highlight] to send them.')
     else:
-      console.print('  :worried_face: [bold red on color(255)] Oh dear, something went wrong. [/bold red on color(255)]') # Print error in red
-    time.sleep(2) # don't fire off requests too quickly
+      lines.append(message + 'Run the same command again to have another go.')
+  return '\n'.join(lines)
+
+# send whatever was left unsent by interrupted commands
+def resume(consumer_key, pocket_access_token):
+
+  start_command()
+  if not journal_path:
+    return '  [highlight] There is no journal to resume from: set [command] journal [/command] in your config file. [/highlight]'
+  conn = journal.connect(journal_path)
+  try:
+    runs = journal.unfinished_runs(conn, store.account_key(pocket_access_token))
+    if len(runs) == 0:
+      return '  [highlight] Nothing to resume. [/highlight]'
+    failed = 0
+    refused = 0
+    for run_id, command, created in runs:
+      pending = journal.pending_batches(conn, run_id)
+      started = datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M')
+      console.print('  Resuming [command] ' + str(command or 'changes') + ' [/command] from ' + started + ' with [highlight] ' + str(sum(len(batch) for seq, batch in pending)) + ' [/highlight] actions left to send...')
+      run_failed, run_refused = send_planned(pending, consumer_key, pocket_access_token, conn, run_id)
+      failed += run_failed
+      refused += run_refused
+      journal.finish_run(conn, run_id)
+  finally:
+    conn.close()
+
+  # refusals are done with, so only say how many there were
+  message = failed_message(0, refused)
+  if failed:
+    return (message + '\n' if message else '') + '  [bold red on color(255)] ' + str(failed) + ' batches still could not be sent. [/bold red on color(255)] Run [highlight] pocketsnack --resume [/highlight] again later.'
+  return message or '  :white_heavy_check_mark: [highlight] Everything has been sent. [/highlight]'
 
 # ----------------
 # Configuration
@@ -154,6 +587,8 @@ def config(config_file):
       new_config.write('num_videos: null\n')
       new_config.write('num_images: null\n')
       new_config.write('num_longreads: 2\n')
+      new_config.write('local_store: ~/.pocketsnack_store.db\n')
+      new_config.write('journal: ~/.pocketsnack_journal.db\n')
       new_config.write('pocket_access_token: null')
       new_config.close()
 
@@ -188,7 +623,7 @@ def authorise(config_file, consumer_key): # With an 's'. Deal with it.
   redirect_uri = 'https://hugh.run/success'
   paramsOne = {"consumer_key": consumer_key, "redirect_uri": redirect_uri}
   # set up step 1 request - this should return a 'code' aka 'request token'
-  requestOne = requests.post('https://getpocket.com/v3/oauth/request', headers=headers, params=paramsOne)
+  requestOne = session().post(api_url + '/oauth/request', headers=headers, params=paramsOne, timeout=timeout)
   # get the JSON response and save the token to a param for the next step
   request_token = requestOne.json()['code']
   # print the request token to the console so you know it happened
@@ -210,7 +645,7 @@ def authorise(config_file, consumer_key): # With an 's'. Deal with it.
     # now we can continue
     # do a new request, this time to the oauth/authorize endpoint with the same JSON headers, but also sending the code as a param
     paramsTwo = {"consumer_key": consumer_key, "code": request_token}
-    requestTwo = requests.post('https://getpocket.com/v3/oauth/authorize', headers=headers, params=paramsTwo)
+    requestTwo = session().post(api_url + '/oauth/authorize', headers=headers, params=paramsTwo, timeout=timeout)
     # get the JSON response as a Python dictionary and call it 'res'.
     res = requestTwo.json()
     # Finally we have the access token!
@@ -229,7 +664,7 @@ def authorise(config_file, consumer_key): # With an 's'. Deal with it.
 # Read info about Pocket account
 # ------------------------------
 
-def info(consumer_key, pocket_access_token, archive_tag, before, since):
+def info_params(consumer_key, pocket_access_token, archive_tag):
 
   params = {
     "consumer_key": consumer_key, 
@@ -242,216 +677,232 @@ def info(consumer_key, pocket_access_token, archive_tag, before, since):
   else:
     # state is unread
     params['state'] = 'unread'
+  return params
+
+# the item fields each command reads (see items.py)
+info_fields = {'word_count', 'has_video', 'has_image'}
+
+def info(consumer_key, pocket_access_token, archive_tag, before, since, between=None):
 
-  items =  get_item_list(params, before, since)
+  start_command()
+  params = info_params(consumer_key, pocket_access_token, archive_tag)
+  items =  get_item_list(params, before, since, between, info_fields)
   return items
 
+# the stats need tags, which are only included in the complete details
+info_stats_fields = {'word_count', 'has_video', 'has_image', 'favorite', 'time_added', 'tags', 'given_url', 'resolved_url'}
+
+# word counts, ages, top domains and tags etc in a single pass (see stats.py)
+# with fields=info_fields only the counts are right, but we don't need the complete details
+def info_stats(consumer_key, pocket_access_token, archive_tag, longreads_wordcount, before, since, between=None, top=10, fields=info_stats_fields):
+
+  start_command()
+  params = info_params(consumer_key, pocket_access_token, archive_tag)
+  summary = stats.ItemStats(longreads_wordcount, top)
+  with metrics.timer('count stats'):
+    for item_id, item in iter_item_list(params, before, since, between, fields):
+      summary.add(item)
+  return summary.summary()
+
 # -----------------------------------
 # lucky dip from archive back to list
 # -----------------------------------
 
-def lucky_dip(consumer_key, pocket_access_token, archive_tag, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount, before, since):
-
-  def run_lucky_dip(attempts):
-    if connection_live() == True:
-      # This function is called below to un-archive everything in the selection
-      def readd(selection):
-        actions = []
-        for item in selection:
-          item_readd = {"item_id": item, "action": "readd"}
-          actions.append(item_readd)
-          # remove archive_tag as well, otherwise the item will keep appearing after it's read and archived by the user
-          item_detag = {"item_id": item, "action": "tags_remove", "tags": archive_tag}
-          actions.append(item_detag)
-        # stringify
-        items_string = json.dumps(actions)
-        escaped = urllib.parse.quote(items_string)
-        # re-add items
-        return send(escaped, consumer_key, pocket_access_token)
-
-      # get everything in the archive with the archive_tag
-      params = {"consumer_key": consumer_key, "access_token": pocket_access_token, "state": "archive", "tag": archive_tag}
-
-      tbr = get_item_list(params, before, since)
-
-      # before we go any further, make sure there actually is something in the TBR list!
-      if len(tbr) > 0:
-        available = len(tbr) # set this value here before it gets changed
-        # just to make it clearer, and create a copy
-        items_needed = items_per_cycle
-
-        # we'll use this to report what was added
-        chosen = {}
-
-        # filtering formats
-        # -----------------
-        videos = []
-        images = []
-
-        for item in tbr:
-          if num_videos and 'has_video' in tbr[item]:
-            if tbr[item]['has_video'] == '2':
-              # it's a video
-              videos.append(item)
-          if num_images and 'has_image' in tbr[item]:
-            if tbr[item]['has_image'] == '2':
-              # it's an image
-              images.append(item)
-
-        if num_videos:
-          # don't select more than the total items_needed
-          required_videos = items_needed if items_needed <= num_videos else num_videos
-          selected_videos = videos if len(videos) <= required_videos else random.sample(videos, required_videos)
-          # re-add the videos
-          if len(selected_videos) > 0:
-            readd(selected_videos)
-            # adjust the total items we need to look for
-            items_needed -= len(selected_videos)
-          chosen['videos'] = len(selected_videos)
-
-        if num_images:
-          required_images = num_images if num_images <= items_needed else items_needed
-          selected_images = images if len(images) <= required_images else random.sample(images, required_images)
-          if len(selected_images) > 0:
-            readd(selected_images)
-            # adjust the total items we need to look for
-            items_needed -= len(selected_images)
-          chosen['images'] = len(selected_images)
-
-        # filtering longreads
-        # -------------------
-        if num_longreads:
-          long_reads = []
-          for item in tbr:
-            # is it a long read?
-            if 'word_count' in tbr[item]:
-              words = int(tbr[item]['word_count'])
-              if words > longreads_wordcount:
-                long_reads.append(item) # we only need to append the item_id
-
-          total_longreads = len(long_reads)
-          total_shortreads = len(tbr) - total_longreads
-          required_shortreads = items_needed - num_longreads
-          enough_longreads = total_longreads >= num_longreads
-          enough_shortreads = total_shortreads >= required_shortreads
-
-          # if there are enough longreads AND enough shortreads, go ahead
-          if enough_longreads and enough_shortreads:
-            # select random longreads
-            # note we need to check whether any are actually required at this point, otherwise we run the risk of items_needed becoming a negative number
-            selected_longreads = (random.sample(long_reads, num_longreads)) if items_needed > 0 else []
-            # add random shortreads
-            # first we need to remove the longreads from tbr:
-            for article in long_reads:
-              tbr.pop(article, None)
-            # now grab a random selection to fill our items_needed quota
-            selected_shortreads = random.sample(list(tbr), required_shortreads) if required_shortreads > 0 else []
-            # add the two lists together
-            selection = selected_longreads + selected_shortreads
-            chosen['longreads'] = len(selected_longreads)
-            chosen['shortreads'] = len(selected_shortreads)
-            readd(selection)
-          # If there are too few longreads but enough shortreads, take what LR we have and make up the difference
-          elif enough_shortreads:
-            # select all of the longreads
-            selected_longreads = long_reads
-            # add random shortreads
-            # first we need to remove the longreads from tbr:
-            for article in long_reads:
-              tbr.pop(article, None)
-            # now grab a random selection to fill our items_needed quota
-            difference = items_needed - len(selected_longreads)
-            # make sure you have enough of the new total
-            enough_difference = difference <= total_shortreads
-            if enough_difference:
-              selected_shortreads = random.sample(list(tbr), difference) if difference > 0 else []
-            # if there are too few longreads AND too few shortreads just grab what shortreads you have
-            else:
-              selected_shortreads = list(tbr) # note this is the new tbr after we popped the longreads
-            # add the two lists together
-            selection = selected_longreads + selected_shortreads
-            chosen['longreads'] = len(selected_longreads)
-            chosen['shortreads'] = len(selected_shortreads)
-            readd(selection)
-          # if there are enough longreads but too few shortreads, use all the shortreads and make up the difference with longreads
-          elif enough_longreads:
-            # add all the shortreads there are
-            # first we need to remove the longreads from tbr:
-            for article in long_reads:
-              tbr.pop(article, None)
-            # the new tbr is now entirely shortreads
-            selected_shortreads = list(tbr)
-            # now grab a random selection of long reads to fill our items_needed quota
-            difference = items_needed - len(selected_shortreads)
-            # make sure you have enough of the new total
-            enough_difference = difference <= total_longreads
-            if enough_difference:
-              selected_longreads = random.sample(long_reads, difference) if difference > 0 else []
-            # if there are too few longreads AND too few shortreads just grab what longreads you have
-            else:
-              selected_longreads = long_reads
-            # add the two lists together
-            selection = selected_longreads + selected_shortreads
-            chosen['longreads'] = len(selected_longreads)
-            chosen['shortreads'] = len(selected_shortreads)
-            readd(selection)
-          else:
-            # if we get to here there aren't enough of either, so we should just return everything
-            chosen['longreads'] = total_longreads
-            chosen['shortreads'] = total_shortreads
-            readd(list(tbr))
-        else: # if num_longreads is False or 0 (which are the same thing)
-          # check how many items in total there are in the TBR list
-          # if there are fewer than items_needed, just return all of them, otherwise get a random selection
-          if items_needed > 0:
-            selection = list(tbr) if len(tbr) < items_needed else random.sample(list(tbr), items_needed)
-            chosen['random'] = len(selection)
-            readd(selection)
-      # return a total of what was moved into the list (faves, format etc)
-        tot_videos = chosen['videos'] if 'videos' in chosen else None
-        tot_images = chosen['images'] if 'images' in chosen else None
-        random_choice = 'random' in chosen
-        tot_added = 0
-        for v in chosen.values():
-          tot_added += v
-        remaining = available - tot_added
-        completed_message = '  Success! [highlight] ' + str(tot_added) + ' [/highlight] items added to your reading list, including [highlight] '
-        if random_choice:
-          completed_message += str(chosen['random']) + ' [/highlight] random articles, [highlight] '
-        if tot_images:
-          completed_message += str(tot_images) + ' [/highlight] images, [highlight] '
-        if tot_videos:
-          completed_message += str(tot_videos) + ' [/highlight] videos, [highlight] '
-        if not random_choice:
-          completed_message += str(chosen['longreads']) + ' [/highlight] long reads and [highlight] ' + str(chosen['shortreads']) + ' [/highlight] short reads, '
-        # add this to the end regardless
-        caveat = ''
-        if before:
-          caveat = 'last updated earlier than [highlight] ' + str(before) + ' [/highlight] days ago '
-        if since:
-          caveat = 'last updated more recently than [highlight] ' + str(since) + ' [/highlight] days ago '
-        completed_message += 'with [highlight] ' + str(remaining) + ' [/highlight] other items ' + caveat + 'remaining to be read.'
-        return completed_message
-      # else if there's nothing tagged with the archive_tag
-      else:
-        return '  [highlight] Nothing to be read! [/highlight]'
+# This is called to un-archive everything in the selection
+def readd_actions(selection, archive_tag):
+  actions = []
+  for item in selection:
+    item_readd = {"item_id": item, "action": "readd"}
+    actions.append(item_readd)
+    # remove archive_tag as well, otherwise the item will keep appearing after it's read and archived by the user
+    item_detag = {"item_id": item, "action": "tags_remove", "tags": archive_tag}
+    actions.append(item_detag)
+  return actions
+
+# lucky dip picks at random, favouring items according to
+# 'lucky_dip_weights' if it's set (see make_scorer in sampling.py)
+# 'lucky_dip_seed' makes the choice the same on every run, for testing
+lucky_dip_score = None
+lucky_dip_rng = random.Random()
+# the item fields lucky dip reads, plus whatever the weights look at
+# None (every field) if the weights are a function
+lucky_dip_fields = {'word_count', 'has_video', 'has_image'}
+
+def set_lucky_dip(weights, seed=None):
+  global lucky_dip_score, lucky_dip_rng, lucky_dip_fields
+  lucky_dip_score = sampling.make_scorer(weights)
+  lucky_dip_rng = random.Random(seed)
+  scored = sampling.scorer_fields(weights)
+  lucky_dip_fields = None if scored is None else {'word_count', 'has_video', 'has_image'} | scored
+
+# choose which items from the TBR archive come back to the list
+# This takes a single pass over the items, so they can be streamed
+# straight from Pocket or the local store. Each item goes into a
+# reservoir (see sampling.py) for every stratum it belongs to - video,
+# image, and either long read or short read - and we count how many
+# of each there are. The quotas are then filled from the reservoirs in
+# order: videos, images, then long and short reads. Anything already
+# chosen is skipped, so an item is never picked twice.
+#
+# Reservoirs after the first hold 2 * items_per_cycle entries: at most
+# items_per_cycle items can already have been chosen from an earlier
+# stratum, which leaves enough to fill any quota.
+#
+# returns the item ids to re-add, a count of what was chosen, and how
+# many items there were altogether
+def choose_lucky_dip(items, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount):
+  size = max(1, items_per_cycle)
+  videos = sampling.Reservoir(size, lucky_dip_rng)
+  images = sampling.Reservoir(2 * size, lucky_dip_rng)
+  long_reads = sampling.Reservoir(2 * size, lucky_dip_rng)
+  short_reads = sampling.Reservoir(2 * size, lucky_dip_rng) # everything else if num_longreads isn't set
+  available = 0
+
+  for item_id, item in items:
+    available += 1
+    weight = lucky_dip_score(item) if lucky_dip_score else 1
+    # without num_longreads everything counts as a short read
+    is_long = bool(num_longreads) and item.word_count > longreads_wordcount
+    entry = (item_id, is_long)
+    if num_videos and item.has_video == 2:
+      videos.add(entry, weight)
+    if num_images and item.has_image == 2:
+      images.add(entry, weight)
+    if is_long:
+      long_reads.add(entry, weight)
     else:
-      if attempts < 4:
-        attempts += 1
-        time.sleep(10)
-        console.print('  [highlight] Attempting to connect... [/highlight]')
-        return run_lucky_dip(attempts)
-      else:
-        msg = "  [highlight] Sorry, no connection after 4 attempts. [/highlight]"
-        return msg
-
-  return run_lucky_dip(0)
+      short_reads.add(entry, weight)
+
+  # just to make it clearer, and create a copy
+  items_needed = items_per_cycle
+  # we'll use this to report what was added
+  chosen = {}
+  # item_id -> is_long for everything picked so far
+  picked = {}
+
+  def pick(entries):
+    for item_id, is_long in entries:
+      picked[item_id] = is_long
+    return len(entries)
+
+  # how many long (or short) reads haven't been picked already
+  def remaining(reservoir, is_long):
+    return reservoir.seen - sum(1 for long in picked.values() if long == is_long)
+
+  # filtering formats
+  # -----------------
+  if num_videos:
+    # don't select more than the total items_needed
+    required_videos = min(items_needed, num_videos)
+    chosen['videos'] = pick(videos.sample(required_videos, picked))
+    items_needed -= chosen['videos']
+
+  if num_images:
+    required_images = min(num_images, items_needed)
+    chosen['images'] = pick(images.sample(required_images, picked))
+    items_needed -= chosen['images']
+
+  # filtering longreads
+  # -------------------
+  if num_longreads:
+    total_longreads = remaining(long_reads, True)
+    total_shortreads = remaining(short_reads, False)
+    # don't select more than the total items_needed
+    required_longreads = min(num_longreads, items_needed)
+    required_shortreads = items_needed - required_longreads
+    enough_longreads = total_longreads >= required_longreads
+    enough_shortreads = total_shortreads >= required_shortreads
+
+    # if there are enough longreads AND enough shortreads, go ahead
+    if enough_longreads and enough_shortreads:
+      chosen['longreads'] = pick(long_reads.sample(required_longreads, picked))
+      chosen['shortreads'] = pick(short_reads.sample(required_shortreads, picked))
+    # If there are too few longreads but enough shortreads, take what LR we have and make up the difference
+    elif enough_shortreads:
+      chosen['longreads'] = pick(long_reads.available(picked))
+      chosen['shortreads'] = pick(short_reads.sample(items_needed - chosen['longreads'], picked))
+    # if there are enough longreads but too few shortreads, use all the shortreads and make up the difference with longreads
+    elif enough_longreads:
+      chosen['shortreads'] = pick(short_reads.available(picked))
+      chosen['longreads'] = pick(long_reads.sample(items_needed - chosen['shortreads'], picked))
+    else:
+      # if we get to here there aren't enough of either, so we should just return everything
+      chosen['longreads'] = pick(long_reads.available(picked))
+      chosen['shortreads'] = pick(short_reads.available(picked))
+  else: # if num_longreads is False or 0 (which are the same thing)
+    # if there are fewer than items_needed, return all of them, otherwise get a random selection
+    if items_needed > 0:
+      chosen['random'] = pick(short_reads.sample(items_needed, picked))
+
+  return list(picked), chosen, available
+
+# report what lucky_dip moved into the list (faves, format etc)
+def lucky_dip_message(chosen, available, before, since, between=None):
+  tot_videos = chosen['videos'] if 'videos' in chosen else None
+  tot_images = chosen['images'] if 'images' in chosen else None
+  random_choice = 'random' in chosen
+  tot_added = 0
+  for v in chosen.values():
+    tot_added += v
+  remaining = available - tot_added
+  completed_message = '  Success! [highlight] ' + str(tot_added) + ' [/highlight] items added to your reading list, including [highlight] '
+  if random_choice:
+    completed_message += str(chosen['random']) + ' [/highlight] random articles, [highlight] '
+  if tot_images:
+    completed_message += str(tot_images) + ' [/highlight] images, [highlight] '
+  if tot_videos:
+    completed_message += str(tot_videos) + ' [/highlight] videos, [highlight] '
+  if not random_choice:
+    completed_message += str(chosen['longreads']) + ' [/highlight] long reads and [highlight] ' + str(chosen['shortreads']) + ' [/highlight] short reads, '
+  # add this to the end regardless
+  caveat = ''
+  if before:
+    caveat = 'last updated earlier than [highlight] ' + str(before) + ' [/highlight] days ago '
+  if since:
+    caveat = 'last updated more recently than [highlight] ' + str(since) + ' [/highlight] days ago '
+  if between:
+    caveat = 'last updated between [highlight] ' + between[0] + ' [/highlight] and [highlight] ' + between[1] + ' [/highlight] '
+  completed_message += 'with [highlight] ' + str(remaining) + ' [/highlight] other items ' + caveat + 'remaining to be read.'
+  return completed_message
+
+def lucky_dip_params(consumer_key, pocket_access_token, archive_tag):
+  # get everything in the archive with the archive_tag
+  params = {"consumer_key": consumer_key, "access_token": pocket_access_token, "state": "archive", "tag": archive_tag}
+  # weighting by tag needs the complete details
+  if lucky_dip_score:
+    params['detailType'] = 'complete'
+  return params
+
+def lucky_dip(consumer_key, pocket_access_token, archive_tag, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount, before, since, between=None):
+
+  start_command()
+  params = lucky_dip_params(consumer_key, pocket_access_token, archive_tag)
+  items = iter_item_list(params, before, since, between, lucky_dip_fields)
+  # the time spent fetching pages is recorded separately, see metrics.py
+  with metrics.timer('choose lucky dip'):
+    selection, chosen, available = choose_lucky_dip(items, items_per_cycle, num_videos, num_images, num_longreads, longreads_wordcount)
+
+  # before we go any further, make sure there actually is something in the TBR list!
+  if available > 0:
+    # re-add everything in one go
+    actions = readd_actions(selection, archive_tag)
+    if dry_run:
+      planner = plan.Planner()
+      planner.count(actions)
+      return dry_run_report(planner, actions)
+    failed, refused = process_items(actions, consumer_key, pocket_access_token, 'lucky dip')
+    if failed or refused:
+      return failed_message(failed, refused)
+    return lucky_dip_message(chosen, available, before, since, between)
+  # else if there's nothing tagged with the archive_tag
+  else:
+    return '  [highlight] Nothing to be read! [/highlight]'
 
 # -----------------
 #  purge tags
 # -----------------
 
-def purge_tags(state, retain_tags, archive_tag, consumer_key, pocket_access_token, before, since):
+def purge_params(state, archive_tag, consumer_key, pocket_access_token):
 
   params = {
     "consumer_key": consumer_key, 
@@ -463,37 +914,53 @@ def purge_tags(state, retain_tags, archive_tag, consumer_key, pocket_access_toke
   if state == "tbr":
     params['state'] = 'archive'
     params['tag'] = archive_tag
+  return params
 
-  # check we're online
-  if connection_live() == True:
-    # GET the list
-    request = get_item_list(params, before, since)
-    actions = []
-
-    if len(request) > 0:
-      for item in request:
-        item_tags = []
-        # find the item tags
-        if 'tags' in request[item]:
-          for tag in request[item]['tags']:
-            item_tags.append(tag)
-        # keep any retain_tags like we use in stash
-        retain_tags.add(archive_tag) # we don't want to wipe out the archive tag on archived items!
-        update = {"item_id": item} 
-        intersect = list(retain_tags.intersection(item_tags))
-        if len(intersect) > 0:
-          update['action'] = 'tags_replace' # item is the ID because it's the dict key
-          update["tags"] = intersect # update tags to keep the retain_tags
-        # otherwise just clear all tags
-        else:
-          update['action'] = 'tags_clear' # item is the ID because it's the dict key
-        actions.append(update)
-      
-      process_items(actions, consumer_key, pocket_access_token)
-      return '  [highlight] Undesirable elements have been purged. [/highlight]' 
-    
+# purge only looks at the tags
+purge_fields = {'tags'}
+
+# build the purge actions as items arrive
+# actions that wouldn't change anything are left out (see plan.py)
+def purge_actions(items, retain_tags, archive_tag, planner=None):
+  planner = planner or plan.Planner()
+  actions = []
+  retain_tags.add(archive_tag) # we don't want to wipe out the archive tag on archived items!
+
+  for item, detail in items:
+    # keep any retain_tags like we use in stash
+    update = {"item_id": item} 
+    intersect = list(retain_tags.intersection(detail.tags))
+    if len(intersect) > 0:
+      update['action'] = 'tags_replace' # item is the ID because it's the dict key
+      update["tags"] = intersect # update tags to keep the retain_tags
+    # otherwise just clear all tags
     else:
-      return '[highlight]  No items from which to purge tags. [/highlight]'
+      update['action'] = 'tags_clear' # item is the ID because it's the dict key
+    if planner.keep(update, detail):
+      actions.append(update)
+  return actions
+
+def purge_tags(state, retain_tags, archive_tag, consumer_key, pocket_access_token, before, since, between=None):
+
+  start_command()
+  params = purge_params(state, archive_tag, consumer_key, pocket_access_token)
+
+  # GET the list, building actions as each page arrives
+  planner = plan.Planner()
+  with metrics.timer('build actions'):
+    actions = purge_actions(iter_item_list(params, before, since, between, purge_fields), retain_tags, archive_tag, planner)
+
+  if dry_run:
+    return dry_run_report(planner, actions)
+
+  if len(actions) > 0:
+    failed, refused = process_items(actions, consumer_key, pocket_access_token, 'purge')
+    if failed or refused:
+      return failed_message(failed, refused)
+    return '  [highlight] Undesirable elements have been purged. [/highlight]' 
+  
+  else:
+    return '[highlight]  No items from which to purge tags. [/highlight]'
 
 """
 Stash
@@ -517,83 +984,93 @@ Options:
 # stash items
 # -----------------
 
-def stash(consumer_key, pocket_access_token, archive_tag, replace_all_tags, retain_tags, favorite, ignore_tags, before, since):
-  console.print('  [highlight] Stashing items... [/highlight]')
+def stash_params(consumer_key, pocket_access_token, favorite):
   # if ignore_faves is set to True, don't get favorite items
   params = {"consumer_key": consumer_key, "access_token": pocket_access_token, "detailType": "complete", "state": "unread"}
   if favorite:
     params['favorite'] = "0"
+  return params
+
+# stash looks at the tags, and whether the item is already archived
+stash_fields = {'tags', 'status'}
+
+# build the tag actions as items arrive
+# returns the tag actions, the ids of the items to archive, and how many items we looked at
+# each item gets its tag action followed by its archive action, so both
+# go out in the same batches in a single pass
+# actions that wouldn't change anything are left out (see plan.py)
+def stash_actions(items, archive_tag, replace_all_tags, retain_tags, ignore_tags, planner=None):
+  planner = planner or plan.Planner()
+  # we store all the 'actions' in an array, then send them to the Pocket API in batches
+  actions = []
+  # ids of the items we will archive
+  items_to_stash = []
+  total_items = 0
+  for item, detail in items:
+    total_items += 1
+    item_tags = detail.tags
+
+    # filter out any items with the ignore tags before dealing with the rest
+    if len(ignore_tags) > 0 and len(ignore_tags.intersection(item_tags)) > 0:
+      # leave it out of items_to_stash
+      continue
+    items_to_stash.append(item)
+    if replace_all_tags:
+      # set up the action dict
+      action = {"item_id": item, "action": "tags_replace"} # item is the ID because it's the dict key
+      # are we retaining any tags?
+      if retain_tags: # retain_tags should either be False or a Set
+        # find the common tags between retain_tags and item_tags
+        # to do this we need retain_tags to be a set, but you can't JSON serialise a set, so we need to turn the result into a list afterwards
+        tags_to_keep = list(retain_tags.intersection(item_tags))
+        # don't forget to add the archive_tag!
+        tags_to_keep.append(archive_tag)
+        action["tags"] = tags_to_keep
+      # Anything that is still in the user list can be presumed to not have been read
+      # when they read it they will archive it (without the archive_tag because lucky_dip removes it)
+      else:
+        action["tags"] = archive_tag
+      if planner.keep(action, detail):
+        actions.append(action)
+    else: # if replace_all_tags is False, just add the archive tag without removing any tags
+      action = {"item_id": item, "action": "tags_add"} # add new tag rather than replacing all of them
+      action["tags"] = archive_tag
+      if planner.keep(action, detail):
+        actions.append(action)
+    # then archive it
+    archive = {"item_id": item, "action": "archive"}
+    if planner.keep(archive, detail):
+      actions.append(archive)
+
+  return actions, items_to_stash, total_items
+
+def stash_message(archive_tag, items_to_stash, total_items):
+  # return a list of what was stashed and, if relevant, what wasn't
+  skipped_items = total_items - len(items_to_stash)
+  return '  [highlight] ' + str(len(items_to_stash)) + ' [/highlight] items archived with [command] "' + archive_tag + '" [/command] and [highlight] ' + str(skipped_items) + ' [/highlight] items skipped due to retain tag.'
+
+def stash(consumer_key, pocket_access_token, archive_tag, replace_all_tags, retain_tags, favorite, ignore_tags, before, since, between=None):
+  start_command()
+  console.print('  [highlight] Stashing items... [/highlight]')
+  params = stash_params(consumer_key, pocket_access_token, favorite)
+  if favorite:
     console.print('  Skipping favorited items...')
 
-  def run_stash(attempts):
-    if connection_live() == True:
-      # GET the list
-      item_list = get_item_list(params, before, since)
-      # we store all the 'actions' in an array, then send one big HTTP request to the Pocket API
-      actions = []
-      # copy items_list so we can alter the copy whilst iterating through the original
-      items_to_stash = dict(item_list)
-      for item in item_list:
-        item_tags = []
-        if 'tags' in item_list[item]:
-          for tag in item_list[item]['tags']:
-            item_tags.append(tag)
-
-        # filter out any items with the ignore tags before dealing with the rest
-        if len(ignore_tags) > 0 and len(ignore_tags.intersection(item_tags)) > 0:
-            # pop it out of the items_to_stash
-            items_to_stash.pop(item, None)
-        # Now we process all the tags first, before we archive everything
-        elif replace_all_tags:
-          # set up the action dict
-          action = {"item_id": item, "action": "tags_replace"} # item is the ID because it's the dict key
-          # are we retaining any tags?
-          if retain_tags: # retain_tags should either be False or a Set
-            # find the common tags between retain_tags and item_tags
-            # to do this we need retain_tags to be a set, but you can't JSON serialise a set, so we need to turn the result into a list afterwards
-            tags_to_keep = list(retain_tags.intersection(item_tags))
-            # don't forget to add the archive_tag!
-            tags_to_keep.append(archive_tag)
-            action["tags"] = tags_to_keep
-          # Anything that is still in the user list can be presumed to not have been read
-          # when they read it they will archive it (without the archive_tag because lucky_dip removes it)
-          else:
-            action["tags"] = archive_tag
-          actions.append(action)
-        else: # if replace_all_tags is False, just add the archive tag without removing any tags
-          action = {"item_id": item, "action": "tags_add"} # add new tag rather than replacing all of them
-          action["tags"] = archive_tag
-          actions.append(action)
-
-      # Update the tags
-      process_items(actions, consumer_key, pocket_access_token)
-
-      # Now archive everything
-      archive_actions = []
+  # GET the list, building actions as each page arrives
+  planner = plan.Planner()
+  with metrics.timer('build actions'):
+    actions, items_to_stash, total_items = stash_actions(iter_item_list(params, before, since, between, stash_fields), archive_tag, replace_all_tags, retain_tags, ignore_tags, planner)
 
-      for item in items_to_stash:
-        item_action = {"item_id": item, "action": "archive"}
-        archive_actions.append(item_action)
+  if dry_run:
+    return dry_run_report(planner, actions)
 
-      console.print('  Archiving [highlight] ' + str(len(archive_actions)) + ' [/highlight] items...')
+  # tag and archive everything in one go
+  console.print('  Tagging and archiving [highlight] ' + str(len(items_to_stash)) + ' [/highlight] items...')
+  failed, refused = process_items(actions, consumer_key, pocket_access_token, 'stash')
+  if failed or refused:
+    return failed_message(failed, refused)
 
-        # archive items
-      process_items(archive_actions, consumer_key, pocket_access_token)
-
-      # return a list of what was stashed and, if relevant, what wasn't
-      skipped_items = len(item_list) - len(items_to_stash)
-      return '  [highlight] ' + str(len(items_to_stash)) + ' [/highlight] items archived with [command] "' + archive_tag + '" [/command] and [highlight] ' + str(skipped_items) + ' [/highlight] items skipped due to retain tag.'
-    else:
-      if attempts < 4:
-        attempts += 1
-        time.sleep(10)
-        console.print('  [highlight] Attempting to connect... [/highlight]')
-        return run_stash(attempts)
-      else:
-        msg = "  [highlight] Sorry, no connection after 4 attempts. [/highlight]"
-        return msg
-
-  return run_stash(0)
+  return stash_message(archive_tag, items_to_stash, total_items)
 
 # -----------------
 # test
@@ -613,7 +1090,7 @@ def test(consumer_key, pocket_access_token):
 # de-duplicate
 # -----------------
 
-def dedupe(state, tag, fave_dupes, consumer_key, pocket_access_token):
+def dedupe_params(state, tag, consumer_key, pocket_access_token):
 
   # Retrieving items
   # ----------------
@@ -629,83 +1106,119 @@ def dedupe(state, tag, fave_dupes, consumer_key, pocket_access_token):
 
   if tag:
     parameters['tag'] = tag  # if tag exists, add it to parameters
+  return parameters
 
-  retrieved = get(parameters)
-  # our items will be under the JSON object's "list" key
-  item_list = retrieved.json()['list']
-  
-  # make a new dictionary called 'summary'
-  # we will use this to look for duplicates
-  summary = {}  
-
-  # and make a list called 'items_to_delete'
-  items_to_delete = []
-  # the originals will be faved if the config file says to do that
-  items_to_fave = []
-
-  # loop over each key (not the whole object) in item_list
-  # 'item' here refers to each item's key, not the whole object/dictionary
-  console.print('  Checking [highlight] ' + str(len(item_list)) + ' [/highlight] items...')
-  for item in item_list:
-    # conveniently the key Pocket uses is the item_id!
-    item_id = item
+# dedupe only needs the urls
+dedupe_fields = {'given_url', 'resolved_url'}
+
+# generally we want to use the 'resolved url' but sometimes that might not exist
+# if so, use the 'given url' instead
+def item_url(item):
+  return item.url
 
+# group item ids by canonical url as items arrive
+# returns how many items were checked and a dict of every url that occurs more than once
+def find_duplicates(items, rules=None):
+
+  # the index only holds a short hash for each url, plus the full
+  # url and ids for the ones that turn out to have duplicates
+  index = urls.UrlIndex(urls.make_rules(rules))
+
+  # loop over each item as the pages arrive from Pocket
+  # conveniently the key Pocket uses is the item_id!
+  checked = 0
+  for item_id, item in items:
+    checked += 1
     # we need the item_id from this request so we can use it in the next API call to delete it
-    # get the URL by pulling out the value from the dict using the key
-    # generally we want to use the 'resolved url' but sometimes that might not exist
-    # if so, use the 'given url' instead
-    if not 'resolved_url' in item_list[item]:
-      # item_list is a Python dictionary where each value is itself another dictionary
-      # or in JSON terms, it's an object where each value is another object
-      # below we are getting the value of the current item id (i.e the first dict), then checking if there is a value within the second dict for the key 'given_url'
-      item_url = item_list[item]['given_url']
-    else:  
-      item_url = item_list[item]['resolved_url']
-    
-    # check whether the resolved_url is already in 'summary'
-    # if it isn't, make a new entry with resolved_url as the key and a list holding item_id as the value - basically we're reversing the logic of 'item_list'. This will allow us to check for duplicates easily in a moment.
-    if not item_url in summary:
-      summary[item_url] = [item_id]
-    # if it is there already, add the item_id into the existing list
+    index.add(item_id, item_url(item))
+
+  return checked, index.duplicate_groups()
+
+# with a local store we keep the url index between runs
+# so only items changed since the last dedupe need checking
+# returns the same as find_duplicates, plus a function to call once the duplicates are dealt with
+def find_new_duplicates(parameters, rules=None):
+  rules = urls.make_rules(rules)
+  conn, account = sync_store(parameters['consumer_key'], parameters['access_token'])
+  try:
+    with conn:
+      # new rules make new keys
+      fingerprint = json.dumps(rules, sort_keys=True)
+      if store.get_url_rules(conn, account) != fingerprint:
+        store.reset_url_keys(conn, account, fingerprint)
+      store.set_url_keys(conn, account, ((item_id, urls.url_key(item_url(item), rules)) for item_id, item in store.missing_url_keys(conn, account)))
+
+    # one scope for each combination of state and tag, so --all covers list and archive in one go
+    scope = json.dumps([parameters.get('state'), parameters.get('tag')])
+    checked, groups = store.duplicate_groups(conn, account, parameters, store.get_dedupe_since(conn, account, scope))
+    since = store.get_since(conn, account)
+  finally:
+    conn.close()
+
+  duplicates = {}
+  for group in groups:
+    duplicates[urls.canonical_url(item_url(group[0][1]), rules)] = [item_id for item_id, item in group]
+
+  def mark_done():
+    conn = store.connect(local_store)
+    with conn:
+      store.set_dedupe_since(conn, account, scope, since)
+    conn.close()
+
+  return checked, duplicates, mark_done
+
+# build the delete and favorite actions for a set of duplicates
+def dedupe_actions(duplicates, fave_dupes):
+
+  # With our list of duplicate item ids, we create one final list of a bunch of JSON objects
+  actions = []
+  faves = []
+
+  for url, ids in duplicates.items():
+    # keep only the most recently added item by slicing the list to make a new list of everything except the last one (which will be the *first* one that was found)
+    for item_id in ids[:-1]:
+      actions.append({"action":"delete", "item_id": item_id})
+
+    if fave_dupes:
+      # get last item (which we are keeping) and add to faving list
+      faves.append({"action":"favorite", "item_id": ids[-1]})
+
+  return actions, faves
+
+def dedupe(state, tag, fave_dupes, consumer_key, pocket_access_token, rules=None):
+
+  start_command()
+  parameters = dedupe_params(state, tag, consumer_key, pocket_access_token)
+
+  with metrics.timer('find duplicates'):
+    if local_store:
+      checked, duplicates, mark_done = find_new_duplicates(parameters, rules)
+      console.print('  Checked [highlight] ' + str(checked) + ' [/highlight] new or changed items...')
     else:
-      summary[item_url].append(item_id)
+      checked, duplicates = find_duplicates(iter_item_list(parameters, False, False, None, dedupe_fields), rules)
+      mark_done = None
+      console.print('  Checked [highlight] ' + str(checked) + ' [/highlight] items...')
 
   # ------------------
   # Finding duplicates
   # ------------------
 
-  # now we look for duplicates (this is why we use the url as the key)
-  for item in summary:
-    
-    # if the length of the list is more than 1, then by definition there must be a duplicate
-    if len(summary[item]) > 1:
-      console.print('  [underline]' + item + '[/underline] occurs [highlight] ' + str(len(summary[item])) + ' [/highlight] times')
-      # keep only the most recently added item by slicing the list to make a new list of everything except the last one (which will be the *first* one that was found)
-      duplicates = summary[item][:-1]
-
-      if fave_dupes:
-        # get last item (which we are keeping) and add to faving list
-        items_to_fave.append(summary[item][-1])
-
-      # add each duplicate in the duplicates list for this url to the items_to_delete list
-      for item in duplicates:
-        items_to_delete.append(item)
+  for url, ids in duplicates.items():
+    console.print('  [underline]' + url + '[/underline] occurs [highlight] ' + str(len(ids)) + ' [/highlight] times')
 
   # Deleting duplicates
   # -------------------
 
   # now use the modify API call to delete duplicate items
   # Docs - https://getpocket.com/developer/docs/v3/modify
+  actions, faves = dedupe_actions(duplicates, fave_dupes)
 
-  # With our list of duplicate item ids, we create one final list of a bunch of JSON objects
-  actions = []
-  faves = []
-  # for each item to be deleted, append a dictionary to the actions list
-  for item_id in items_to_delete:
-    actions.append({"action":"delete", "item_id": item_id})
-
-  for item_id in items_to_fave:
-    faves.append({"action":"favorite", "item_id": item_id})
+  if dry_run and len(actions) > 0:
+    planner = plan.Planner()
+    planner.count(faves)
+    planner.count(actions)
+    console.print(dry_run_report(planner, faves, actions))
+    return
 
   # Double check you really want to delete them
   if len(actions) > 0:
@@ -717,45 +1230,47 @@ def dedupe(state, tag, fave_dupes, consumer_key, pocket_access_token):
     check = input('>>')
     if check == 'delete':
 
+      completed = True
       if fave_dupes:
-        # chunk faving to avoid URL-too-long errors
-        fav_chunks = [faves[i:i+20] for i in range(0, len(faves), 20)]
+        # send faves in batches
+        faved_count = 0
+        for chunk, faved, error in send_batches(faves, consumer_key, pocket_access_token):
 
-        for i, chunk in enumerate(fav_chunks):
-
-          faves_string = json.dumps(chunk)
-          faves_escaped = urllib.parse.quote(faves_string) # URL encode it using urllib
-          faved = send(faves_escaped, consumer_key, pocket_access_token)
+          faved_count += len(chunk)
 
           # provide feedback on what happened
-          # 'deleted' is a raw http response (it should return '<Response [200]>') 
+          # 'faved' is a raw http response (it should return '<Response [200]>') 
           # so we need to turn it into a Python string before we can do a comparison
           if str(faved) == '<Response [200]>':
-            console.print('  Favorited [highlight] ' + str((i*20)+len(chunk)) + ' [/highlight] items...')
+            console.print('  Favorited [highlight] ' + str(faved_count) + ' [/highlight] items...')
           else:
             console.print('  [bold red on color(255)] Something went wrong favoriting your dupes :worried_face: [/bold red on color(255)]')
-            print(faved.text)
+            print(faved.text if faved is not None else error)
+            completed = False
             break
 
-      # chunk deletions to avoid URL-too-long errors
-      del_chunks = [actions[i:i+20] for i in range(0, len(actions), 20)]
-
-      for i, chunk in enumerate(del_chunks):
+      # send deletions in batches
+      deleted_count = 0
+      for chunk, deleted, error in send_batches(actions, consumer_key, pocket_access_token):
 
-        actions_string = json.dumps(chunk)
-        actions_escaped = urllib.parse.quote(actions_string)
-        deleted = send(actions_escaped, consumer_key, pocket_access_token)
+        deleted_count += len(chunk)
 
         if str(deleted) == '<Response [200]>':
-          console.print('  Deleted [highlight] ' + str((i*20)+len(chunk)) + ' [/highlight] items...')
+          console.print('  Deleted [highlight] ' + str(deleted_count) + ' [/highlight] items...')
         else:
           console.print('  [bold red on color(255)] Something went wrong deleting duplicates :worried_face: [/bold red on color(255)]')
-          console.print(deleted.text)
+          console.print(deleted.text if deleted is not None else error)
+          completed = False
           break
 
       console.print('  :white_heavy_check_mark: [highlight] de-duping completed [/highlight]')
+      # if anything went wrong, check the same items again next time
+      if mark_done and completed:
+        mark_done()
 
     else:
       console.print('  :raised_hand: [highlight] deletion cancelled [/highlight]')
   else:
-    console.print('  :party_popper: [highlight] No duplicates found! [/highlight]')
\ No newline at end of file
+    console.print('  :party_popper: [highlight] No duplicates found! [/highlight]')
+    if mark_done:
+      mark_done()
\ No newline at end of file
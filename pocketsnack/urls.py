@@ -0,0 +1,139 @@
+# pocketsnack - KonMari your Pocket tsundoku from the command line
+# Copyright (C) 2018 - 2021 Hugh Rundle
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# You can contact Hugh on email hugh [at] hughrundle [dot] net
+# or Mastodon at @hugh@ausglam.space
+
+# ----------------
+# Import libraries
+# ----------------
+
+# bundled with Python
+from fnmatch import fnmatchcase
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# -----------------------------------------------------------
+# Canonical URLs
+# -----------------------------------------------------------
+# Two Pocket items are the same article if their URLs only differ in
+# ways that don't matter: http vs https, a leading 'www.', a trailing
+# slash, a #fragment, tracking parameters, or an AMP version of the page.
+# canonical_url() strips all of that according to a set of rules, and
+# url_key() hashes the result so an index of a large account stays small.
+#
+# Each rule can be switched off (or the tracking list changed) with
+# 'dedupe_rules' in the config file.
+
+default_rules = {
+  'ignore_scheme': True, # http://x and https://x are the same
+  'ignore_www': True, # www.x.com and x.com are the same
+  'ignore_trailing_slash': True, # x.com/page/ and x.com/page are the same
+  'ignore_fragment': True, # x.com/page#comments and x.com/page are the same
+  'ignore_amp': True, # x.com/page/amp and x.com/page are the same
+  'sort_query': True, # x.com/?a=1&b=2 and x.com/?b=2&a=1 are the same
+  # query parameters to drop - shell-style patterns
+  'tracking_params': ['utm_*', 'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref', 'ref_src', 'cmpid', 'ocid'],
+}
+
+def make_rules(overrides):
+  rules = dict(default_rules)
+  if overrides:
+    rules.update(overrides)
+  return rules
+
+# query parameters that only ask for the AMP version of a page
+amp_params = {'amp', 'outputtype'}
+
+def strip_amp(host, path, query):
+  # Google's AMP cache wraps the real url: www.google.com/amp/s/example.com/page
+  if host in ('google.com', 'www.google.com') and path.startswith('/amp/'):
+    rest = path[len('/amp/'):]
+    if rest.startswith('s/'):
+      rest = rest[2:]
+    host, _, path = rest.partition('/')
+    path = '/' + path
+  if host.startswith('amp.'):
+    host = host[len('amp.'):]
+  if path.startswith('/amp/'):
+    path = path[len('/amp'):]
+  if path.endswith('/amp') or path.endswith('/amp/'):
+    path = path[:path.rindex('/amp')] or '/'
+  path = path.replace('.amp.html', '.html')
+  query = [(key, value) for key, value in query if key.lower() not in amp_params]
+  return host, path, query
+
+def canonical_url(url, rules=default_rules):
+  parts = urlsplit(url.strip())
+  scheme = parts.scheme.lower()
+  host = (parts.hostname or '').lower()
+  if parts.port:
+    host += ':' + str(parts.port)
+  path = parts.path or '/'
+  query = parse_qsl(parts.query, keep_blank_values=True)
+  fragment = parts.fragment
+
+  if rules.get('ignore_amp'):
+    host, path, query = strip_amp(host, path, query)
+  if rules.get('ignore_scheme') and scheme in ('http', 'https'):
+    scheme = 'https'
+  if rules.get('ignore_www') and host.startswith('www.'):
+    host = host[len('www.'):]
+  if rules.get('ignore_trailing_slash') and len(path) > 1:
+    path = path.rstrip('/') or '/'
+  if rules.get('ignore_fragment'):
+    fragment = ''
+  patterns = rules.get('tracking_params') or []
+  if patterns:
+    query = [(key, value) for key, value in query if not any(fnmatchcase(key.lower(), p) for p in patterns)]
+  if rules.get('sort_query'):
+    query = sorted(query)
+
+  return urlunsplit((scheme, host, path, urlencode(query), fragment))
+
+# a short fixed-size key for the index
+def url_key(url, rules=default_rules):
+  return hashlib.blake2b(canonical_url(url, rules).encode('utf-8'), digest_size=16).digest()
+
+# -----------------------------------------------------------
+# URL index
+# -----------------------------------------------------------
+# Built in a single pass as items arrive. For each canonical URL we
+# only keep the 16-byte key and the first item id. A URL only gets a
+# full entry (the readable URL and every id) once a second copy turns up.
+
+class UrlIndex:
+
+  def __init__(self, rules=default_rules):
+    self.rules = rules
+    self.first = {} # key -> first item id seen
+    self.duplicates = {} # key -> (canonical url, [item ids])
+
+  # add an item, returning True if we've seen its URL before
+  def add(self, item_id, url):
+    key = url_key(url, self.rules)
+    if key in self.duplicates:
+      self.duplicates[key][1].append(item_id)
+      return True
+    if key in self.first:
+      self.duplicates[key] = (canonical_url(url, self.rules), [self.first.pop(key), item_id])
+      return True
+    self.first[key] = item_id
+    return False
+
+  # every URL that occurs more than once, with its item ids in the order they arrived
+  def duplicate_groups(self):
+    return {url: ids for url, ids in self.duplicates.values()}